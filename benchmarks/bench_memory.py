@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+'''
+Offline memory benchmark of laporte-mqtt
+
+Feeds synthetic topics of a gateways config (10k and 100k nodes per gateway
+by default) straight into the message processing of the bridge, with the
+change filter and optionally throttling enabled, and reports RSS and
+tracemalloc snapshots after the first pass (all nodes known) and after
+further passes (steady state, which should not grow). Every population
+is measured in a fresh process.
+
+usage: python benchmarks/bench_memory.py [options]
+'''
+
+import gc
+import os
+import sys
+import subprocess
+import tracemalloc
+from argparse import ArgumentParser, SUPPRESS
+from time import perf_counter
+import paho.mqtt.client as mqtt
+from bench_throughput import ROOT, synthetic_topics, synthetic_payload, proc_stats
+
+# pylint: disable=wrong-import-position
+from laporte_mqtt.config import GatewaysConfig  # noqa: E402
+from laporte_mqtt.dedup import ChangeFilter  # noqa: E402
+from laporte_mqtt.throttle import ThrottleConfig  # noqa: E402
+from laporte_mqtt.mqtt import Mqqt  # noqa: E402
+from laporte_mqtt.nodes import node_registry  # noqa: E402
+
+
+class NullSink():
+    '''emit stage counting emits'''
+    def __init__(self):
+        self.emits = 0
+
+    def emit(self, response, message, stamps=None):
+        del response, message, stamps  # Ignored parameters
+        self.emits += 1
+
+
+def feed(bridge, streams, seq):
+    '''process one message of every stream, return the next sequence number'''
+
+    for gateway, topic in streams:
+        msg = mqtt.MQTTMessage(topic=topic.encode())
+        msg.payload = synthetic_payload(gateway, seq, topic)
+        bridge.process_message(msg)
+        seq += 1
+    return seq
+
+
+def measure(args, nodes):
+    '''run one population and print its figures'''
+
+    gateways = GatewaysConfig(args.config)
+    if args.throttle:
+        for gateway in gateways.get():
+            gateway.subscribe_throttle = ThrottleConfig(args.throttle)
+    streams = list(synthetic_topics(gateways, nodes))
+
+    gc.collect()
+    _, rss0, _ = proc_stats(os.getpid())
+    if args.tracemalloc:
+        tracemalloc.start(args.tracemalloc)
+
+    sink = NullSink()
+    bridge = Mqqt(gateways,
+                  None,
+                  sink=sink,
+                  dedup=ChangeFilter(max_age=60, max_entries=10 * len(streams)))
+
+    start = perf_counter()
+    seq = feed(bridge, streams, 0)
+    gc.collect()
+    _, rss1, _ = proc_stats(os.getpid())
+    snapshot1 = tracemalloc.take_snapshot() if args.tracemalloc else None
+
+    for _ in range(args.passes - 1):
+        seq = feed(bridge, streams, seq)
+    elapsed = perf_counter() - start
+    gc.collect()
+    _, rss2, hwm = proc_stats(os.getpid())
+
+    print(f"nodes:          {nodes} per gateway, {len(streams)} topics, "
+          f"{len(node_registry)} registered nodes")
+    print(f"processed:      {seq} msgs in {elapsed:.2f} s ({seq / elapsed:.0f} msgs/s), "
+          f"{sink.emits} emits")
+    print(f"rss first pass: +{(rss1 - rss0) / 2**20:.1f} MiB "
+          f"({(rss1 - rss0) / len(streams):.0f} B per topic)")
+    print(f"rss steady:     +{(rss2 - rss1) / 2**20:.1f} MiB after {args.passes - 1} "
+          f"more passes (peak {hwm / 2**20:.1f} MiB)")
+
+    if args.tracemalloc:
+        snapshot2 = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        print(f"traced:         {current / 2**20:.1f} MiB (peak {peak / 2**20:.1f} MiB)")
+        print("top allocations:")
+        for stat in snapshot2.statistics('lineno')[:args.top]:
+            print(f"  {stat}")
+        print("growth in steady state:")
+        for stat in snapshot2.compare_to(snapshot1, 'lineno')[:args.top]:
+            print(f"  {stat}")
+
+
+def main():
+    parser = ArgumentParser(description='laporte-mqtt offline memory benchmark')
+    parser.add_argument('-c', '--config', default=os.path.join(ROOT, 'conf',
+                                                              'gateways_example.yml'))
+    parser.add_argument('-n', '--nodes', type=int, nargs='+', default=[10000, 100000],
+                        help='counts of nodes per gateway, each one run separately')
+    parser.add_argument('-p', '--passes', type=int, default=3,
+                        help='messages per topic')
+    parser.add_argument('-w', '--throttle', type=float, default=0,
+                        help='throttle window of all gateways in seconds, 0 = off')
+    parser.add_argument('-t', '--tracemalloc', type=int, default=0, metavar='FRAMES',
+                        help='trace allocations with given stack depth, 0 = off')
+    parser.add_argument('--top', type=int, default=10,
+                        help='count of allocation sites shown')
+    parser.add_argument('--single', action='store_true', help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        measure(args, args.nodes[0])
+        return
+
+    for nodes in args.nodes:
+        cmd = [
+            sys.executable,
+            os.path.abspath(__file__), *sys.argv[1:], '--single', '-n',
+            str(nodes)
+        ]
+        subprocess.run(cmd, check=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
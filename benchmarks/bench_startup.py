@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+'''
+Startup benchmark of laporte-mqtt
+
+Measures wall time of fresh processes importing the bridge modules and
+printing --help (median of repeated runs, the bare interpreter startup
+shown for reference), the slowest imports of the client modules by
+python -X importtime and the time to start and stop several embedded
+bridges in one process against an in-process MQTT broker and a Laporte
+Socket.IO server stand-in.
+
+usage: python benchmarks/bench_startup.py [options]
+'''
+
+import os
+import sys
+import logging
+import statistics
+import subprocess
+from argparse import ArgumentParser
+from time import perf_counter
+from fake_broker import FakeBroker
+from fake_laporte import FakeLaporte
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# pylint: disable=wrong-import-position
+from laporte_mqtt.logger import ConfLogger  # noqa: E402
+from laporte_mqtt.argparser import get_pars  # noqa: E402
+from laporte_mqtt.bridge import Bridge  # noqa: E402
+
+PROCESSES = (
+    ('python', ['-c', 'pass']),
+    ('import bridge', ['-c', 'import laporte_mqtt.bridge']),
+    ('import main', ['-c', 'import laporte_mqtt.main']),
+    ('--help', ['-m', 'laporte_mqtt', '--help']),
+    ('import clients', ['-c', 'import laporte_mqtt.laporte, laporte_mqtt.pool']),
+)
+
+
+def run_process(args, runs):
+    '''return wall times of fresh processes'''
+
+    ret = []
+    for _ in range(runs):
+        start = perf_counter()
+        subprocess.run([sys.executable, *args],
+                       cwd=ROOT,
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL,
+                       check=True)
+        ret.append(perf_counter() - start)
+    return ret
+
+
+def import_times(modules, top):
+    '''return (cumulative us, package) of the slowest packages imported by modules'''
+
+    code = f"import {', '.join(modules)}"
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          cwd=ROOT,
+                          stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE,
+                          check=True,
+                          text=True)
+
+    packages = {}
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        package = fields[2].strip().split('.')[0]
+        if package != 'laporte_mqtt':
+            packages[package] = max(packages.get(package, 0), int(fields[1]))
+    return sorted(((cumulative, package) for package, cumulative in packages.items()),
+                  reverse=True)[:top]
+
+
+def start_bridges(args):
+    '''start and stop embedded bridges, print per-bridge times'''
+
+    broker = FakeBroker().start()
+    laporte = FakeLaporte().start()
+    # the werkzeug server takes WebSocket close frames for bad requests
+    logging.getLogger('werkzeug').setLevel(logging.CRITICAL)
+    pars = get_pars([
+        '-H', laporte.host, '-P',
+        str(laporte.port), '-q', broker.host, '-r',
+        str(broker.port), '-c', args.config
+    ])
+
+    bridges = []
+    times = []
+    for _ in range(args.bridges):
+        start = perf_counter()
+        bridge = Bridge(pars)
+        bridge.start()
+        times.append(perf_counter() - start)
+        bridges.append(bridge)
+
+    start = perf_counter()
+    for bridge in bridges:
+        bridge.stop()
+    for bridge in bridges:
+        bridge.thread.join()
+    stopped = perf_counter() - start
+
+    # client modules share most of their imports with the fakes
+    print(f"bridge start:   first {times[0] * 1e3:.0f} ms")
+    if len(times) > 1:
+        print(f"                next {statistics.median(times[1:]) * 1e3:.0f} ms median "
+              f"of {len(times) - 1}")
+    print(f"bridge stop:    {stopped / len(bridges) * 1e3:.0f} ms per bridge "
+          f"(Socket.IO close timeout included)")
+
+    laporte.stop()
+    broker.stop()
+
+
+def main():
+    parser = ArgumentParser(description='laporte-mqtt startup benchmark')
+    parser.add_argument('-c', '--config', default=os.path.join(ROOT, 'conf',
+                                                              'gateways_example.yml'))
+    parser.add_argument('-r', '--runs', type=int, default=7,
+                        help='fresh processes per measurement')
+    parser.add_argument('-n', '--bridges', type=int, default=5,
+                        help='bridges started in one process, 0 = off')
+    parser.add_argument('--top', type=int, default=10,
+                        help='count of slowest imports shown')
+    args = parser.parse_args()
+
+    # laporte client enables Socket.IO loggers with their own handlers
+    ConfLogger(__name__, log_level=logging.CRITICAL)
+    for module in ['socketio.client', 'engineio.client']:
+        logging.getLogger(module).setLevel(logging.CRITICAL)
+
+    for name, process_args in PROCESSES:
+        times = run_process(process_args, args.runs)
+        print(f"{name + ':':<16}{statistics.median(times) * 1e3:>6.0f} ms median, "
+              f"{min(times) * 1e3:.0f} ms min")
+
+    print("slowest packages imported by client modules (cumulative):")
+    for cumulative, name in import_times(['laporte_mqtt.laporte', 'laporte_mqtt.pool'],
+                                         args.top):
+        print(f"  {cumulative / 1e3:>7.1f} ms  {name}")
+
+    if args.bridges > 0:
+        start_bridges(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+'''
+Offline throughput benchmark of laporte-mqtt
+
+Starts an in-process MQTT broker and a Laporte Socket.IO server stand-in,
+runs the bridge (python -m laporte_mqtt) against them, publishes synthetic
+zigbee (json), rflink (value) and tasmota traffic generated from a gateways
+config and reports sustained msgs/s, end-to-end latency, CPU and RSS of the
+bridge process.
+
+usage: python benchmarks/bench_throughput.py [options] [-- bridge options]
+'''
+
+import os
+import sys
+import json
+import socket
+import subprocess
+import threading
+from argparse import ArgumentParser
+from time import monotonic, sleep
+from fake_broker import FakeBroker
+from fake_laporte import FakeLaporte
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# pylint: disable=wrong-import-position
+from laporte_mqtt.config import GatewaysConfig, SCHEMA_JSON, SCHEMA_INFLUX  # noqa: E402
+from laporte_mqtt.router import TopicRouter  # noqa: E402
+
+CLK_TCK = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def free_port():
+    '''return a free TCP port'''
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def synthetic_topics(gateways, nodes):
+    '''
+    yield (gateway, topic) with topics filled into subscribe wildcards,
+    the last '+' of a value schema gateway with more wildcards is a key
+    '''
+
+    router = TopicRouter(gateways.get())
+    for gateway in gateways.get():
+        levels = gateway.subscribe_topic.split('/')
+        wildcards = [i for i, level in enumerate(levels) if level in ('+', '#')]
+        key_level = None
+        if gateway.subscribe_schema != SCHEMA_JSON and len(wildcards) > 1:
+            key_level = wildcards[-1]
+
+        for node in range(nodes):
+            topic = '/'.join(
+                ('k' if i == key_level else f'n{node}') if i in wildcards else level
+                for i, level in enumerate(levels))
+            routes = router.match(topic)
+            if not routes or routes[0].gateway is not gateway:
+                break
+            yield gateway, topic
+
+
+def synthetic_payload(gateway, seq, topic):
+    '''payload carrying the sequence number'''
+
+    if gateway.subscribe_schema == SCHEMA_INFLUX:
+        # measurement (node address) of the last topic level
+        node = topic.rsplit('/', 1)[-1]
+        return f'{node} seq={seq}i,temperature=21.5,humidity=48.2'.encode()
+    if gateway.subscribe_schema == SCHEMA_JSON:
+        return json.dumps({
+            'seq': seq,
+            'temperature': 21.5,
+            'humidity': 48.2,
+            'linkquality': 90
+        }).encode()
+    return str(seq).encode()
+
+
+def proc_stats(pid):
+    '''return (cpu seconds, rss bytes, peak rss bytes) of a process'''
+
+    try:
+        with open(f'/proc/{pid}/stat', encoding='ascii') as stream:
+            fields = stream.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / CLK_TCK
+        rss = hwm = 0
+        with open(f'/proc/{pid}/status', encoding='ascii') as stream:
+            for line in stream:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith('VmHWM:'):
+                    hwm = int(line.split()[1]) * 1024
+        return cpu, rss, hwm
+    except OSError:
+        return 0.0, 0, 0
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def extract_seq(value):
+    '''sequence number of a node value (json dict or {key: value})'''
+
+    if isinstance(value, dict):
+        if 'seq' in value:
+            return value['seq']
+        return next(iter(value.values()), None)
+    return None
+
+
+class LatencyRecorder():
+    '''map sequence numbers in received emits to their send times'''
+    def __init__(self):
+        self.sent = {}
+        self.latencies = []
+        self.emits = 0
+        self.values = 0
+        self.start = None
+        self.last = None
+        self.lock = threading.Lock()
+
+    def on_sensor(self, now, message):
+        with self.lock:
+            self.emits += 1
+            self.last = now
+            for value in message.values():
+                try:
+                    sent = self.sent.pop(int(extract_seq(value)))
+                except (KeyError, TypeError, ValueError):
+                    continue
+                self.values += 1
+                self.latencies.append(now - sent)
+
+
+def generate(broker, recorder, streams, rate, duration):
+    '''publish round-robin over streams, return count of sent messages'''
+
+    seq = 0
+    start = monotonic()
+    recorder.start = start
+    deadline = start + duration
+    while True:
+        now = monotonic()
+        if now >= deadline:
+            break
+        if rate:
+            ahead = seq / rate - (now - start)
+            if ahead > 0:
+                sleep(ahead)
+        gateway, topic = streams[seq % len(streams)]
+        with recorder.lock:
+            recorder.sent[seq] = monotonic()
+        broker.publish(topic, synthetic_payload(gateway, seq, topic))
+        seq += 1
+    return seq, monotonic() - start
+
+
+def main():
+    parser = ArgumentParser(description='laporte-mqtt offline throughput benchmark')
+    parser.add_argument('-c', '--config', default=os.path.join(ROOT, 'conf',
+                                                              'gateways_example.yml'))
+    parser.add_argument('-r', '--rate', type=int, default=1000,
+                        help='messages per second, 0 = as fast as possible')
+    parser.add_argument('-d', '--duration', type=float, default=10.0)
+    parser.add_argument('-n', '--nodes', type=int, default=100,
+                        help='count of nodes per gateway')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show output of the bridge')
+    parser.add_argument('bridge_args', nargs='*', help='extra laporte-mqtt options')
+    args = parser.parse_args()
+
+    gateways = GatewaysConfig(args.config)
+    streams = list(synthetic_topics(gateways, args.nodes))
+    recorder = LatencyRecorder()
+    broker = FakeBroker().start()
+    laporte = FakeLaporte(on_sensor=recorder.on_sensor).start()
+
+    cmd = [
+        sys.executable, '-m', 'laporte_mqtt', '-c', args.config, '-H', laporte.host, '-P',
+        str(laporte.port), '-q', broker.host, '-r',
+        str(broker.port), '-p',
+        str(free_port()), '-l', 'ERROR', *args.bridge_args
+    ]
+    stderr = None if args.verbose else subprocess.DEVNULL
+    with subprocess.Popen(cmd, cwd=ROOT, stderr=stderr) as bridge:
+        try:
+            while len(laporte.rooms) < len(list(gateways.get_names())) or \
+                    not any(session.subscriptions for session in broker.sessions):
+                if bridge.poll() is not None:
+                    sys.exit('bridge exited')
+                sleep(0.1)
+            sleep(0.5)
+
+            cpu0, _, _ = proc_stats(bridge.pid)
+            sent, elapsed = generate(broker, recorder, streams, args.rate, args.duration)
+
+            # drain
+            idle = monotonic()
+            count = recorder.values
+            while monotonic() - idle < 2.0:
+                sleep(0.1)
+                if recorder.values != count:
+                    count = recorder.values
+                    idle = monotonic()
+            cpu1, rss, hwm = proc_stats(bridge.pid)
+        finally:
+            bridge.terminate()
+            bridge.wait()
+
+    latencies = sorted(recorder.latencies)
+    total = (recorder.last or monotonic()) - recorder.start
+    print(f"streams:        {len(streams)} topics of {len(list(gateways.get_names()))} "
+          "gateways")
+    print(f"sent:           {sent} msgs in {elapsed:.2f} s ({sent / elapsed:.0f} msgs/s)")
+    print(f"delivered:      {recorder.values} values in {recorder.emits} emits "
+          f"({recorder.values / max(total, 1e-9):.0f} values/s)")
+    print(f"latency p50:    {percentile(latencies, 0.50) * 1000:.2f} ms")
+    print(f"latency p99:    {percentile(latencies, 0.99) * 1000:.2f} ms")
+    print(f"cpu:            {cpu1 - cpu0:.2f} s "
+          f"({(cpu1 - cpu0) / max(total, 1e-9) * 100:.0f} % of one core)")
+    print(f"rss:            {rss / 2**20:.1f} MiB (peak {hwm / 2**20:.1f} MiB)")
+
+    broker.stop()
+    laporte.stop()
+
+
+if __name__ == '__main__':
+    main()
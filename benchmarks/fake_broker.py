@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+'''
+Minimal in-process MQTT 3.1.1 broker for benchmarks
+(QoS 0 delivery, retained messages, shared subscriptions)
+'''
+
+import socket
+import struct
+import threading
+from itertools import count
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+def topic_matches(topic_filter, topic):
+    '''check a topic against a MQTT topic filter'''
+
+    filter_levels = topic_filter.split('/')
+    levels = topic.split('/')
+    if topic.startswith('$') and filter_levels[0] in ('+', '#'):
+        return False
+    for i, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if i >= len(levels):
+            return False
+        if level not in ('+', levels[i]):
+            return False
+    return len(filter_levels) == len(levels)
+
+
+def encode_length(length):
+    '''encode MQTT remaining length'''
+
+    ret = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        ret.append(byte)
+        if not length:
+            return bytes(ret)
+
+
+def encode_string(value):
+    '''encode MQTT UTF-8 string'''
+
+    data = value.encode('utf8')
+    return struct.pack('!H', len(data)) + data
+
+
+def publish_packet(topic, payload, retain=False):
+    '''encode QoS 0 PUBLISH packet'''
+
+    body = encode_string(topic) + payload
+    return bytes([(PUBLISH << 4) | int(retain)]) + encode_length(len(body)) + body
+
+
+class BrokerSession():
+    '''one connected client'''
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.client_id = None
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+
+    def send(self, data):
+        with self.lock:
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                pass
+
+    def recv_exact(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError('closed')
+            data.extend(chunk)
+        return bytes(data)
+
+    def read_packet(self):
+        '''read a packet, return its first header byte and body'''
+
+        header = self.recv_exact(1)[0]
+        multiplier, length = 1, 0
+        while True:
+            byte = self.recv_exact(1)[0]
+            length += (byte & 0x7f) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header, self.recv_exact(length) if length else b''
+
+    def serve(self):
+        try:
+            while True:
+                header, body = self.read_packet()
+                if not self.handle(header >> 4, header & 0x0f, body):
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.broker.remove(self)
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+    def handle(self, ptype, flags, body):
+        '''handle a packet, return False to close the connection'''
+
+        if ptype == CONNECT:
+            proto_len = struct.unpack('!H', body[:2])[0]
+            pos = 2 + proto_len + 4
+            id_len = struct.unpack('!H', body[pos:pos + 2])[0]
+            self.client_id = body[pos + 2:pos + 2 + id_len].decode('utf8')
+            self.send(bytes([CONNACK << 4, 2, 0, 0]))
+        elif ptype == PUBLISH:
+            qos = (flags >> 1) & 3
+            topic_len = struct.unpack('!H', body[:2])[0]
+            topic = body[2:2 + topic_len].decode('utf8')
+            pos = 2 + topic_len
+            if qos:
+                mid = body[pos:pos + 2]
+                pos += 2
+                self.send(bytes([PUBACK << 4, 2]) + mid)
+            self.broker.publish(topic, body[pos:], retain=bool(flags & 1), origin=self)
+        elif ptype == SUBSCRIBE:
+            mid = body[:2]
+            pos, granted, filters = 2, bytearray(), []
+            while pos < len(body):
+                flen = struct.unpack('!H', body[pos:pos + 2])[0]
+                topic_filter = body[pos + 2:pos + 2 + flen].decode('utf8')
+                pos += 2 + flen + 1
+                granted.append(0)
+                filters.append(topic_filter)
+            self.broker.subscribe(self, filters)
+            self.send(bytes([SUBACK << 4]) + encode_length(len(granted) + 2) + mid +
+                      bytes(granted))
+            self.broker.send_retained(self, filters)
+        elif ptype == UNSUBSCRIBE:
+            mid = body[:2]
+            pos, filters = 2, []
+            while pos < len(body):
+                flen = struct.unpack('!H', body[pos:pos + 2])[0]
+                filters.append(body[pos + 2:pos + 2 + flen].decode('utf8'))
+                pos += 2 + flen
+            self.broker.unsubscribe(self, filters)
+            self.send(bytes([UNSUBACK << 4, 2]) + mid)
+        elif ptype == PINGREQ:
+            self.send(bytes([PINGRESP << 4, 0]))
+        elif ptype == DISCONNECT:
+            return False
+        return True
+
+
+class FakeBroker():
+    '''
+    threaded MQTT broker with QoS 0 delivery, retained messages
+    and $share/<group>/<filter> shared subscriptions
+    '''
+    def __init__(self, host='127.0.0.1', port=0):
+        self.server = socket.create_server((host, port))
+        self.host, self.port = self.server.getsockname()[:2]
+        self.sessions = []
+        self.retained = {}
+        self.received = []
+        self.subscribe_packets = 0
+        self.shared_counter = count()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.accept_loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = BrokerSession(self, sock)
+            with self.lock:
+                self.sessions.append(session)
+            threading.Thread(target=session.serve, daemon=True).start()
+
+    def remove(self, session):
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+
+    def subscribe(self, session, filters):
+        with self.lock:
+            self.subscribe_packets += 1
+            for topic_filter in filters:
+                session.subscriptions[topic_filter] = True
+
+    def unsubscribe(self, session, filters):
+        with self.lock:
+            for topic_filter in filters:
+                session.subscriptions.pop(topic_filter, None)
+
+    @staticmethod
+    def split_shared(topic_filter):
+        if topic_filter.startswith('$share/'):
+            _, group, real_filter = topic_filter.split('/', 2)
+            return group, real_filter
+        return None, topic_filter
+
+    def send_retained(self, session, filters):
+        for topic_filter in filters:
+            _, real_filter = self.split_shared(topic_filter)
+            for topic, payload in list(self.retained.items()):
+                if topic_matches(real_filter, topic):
+                    session.send(publish_packet(topic, payload, retain=True))
+
+    def publish(self, topic, payload, retain=False, origin=None):
+        '''deliver a message to subscribers, record messages from clients'''
+
+        if origin is not None:
+            self.received.append((topic, payload))
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+
+        packet = publish_packet(topic, payload)
+        targets, groups = [], {}
+        with self.lock:
+            for session in self.sessions:
+                for topic_filter in session.subscriptions:
+                    group, real_filter = self.split_shared(topic_filter)
+                    if topic_matches(real_filter, topic):
+                        if group is None:
+                            targets.append(session)
+                        else:
+                            groups.setdefault((group, real_filter), []).append(session)
+        for members in groups.values():
+            targets.append(members[next(self.shared_counter) % len(members)])
+        for session in targets:
+            session.send(packet)
+
+    def drop_clients(self):
+        '''close all client connections (simulates a broker blip)'''
+
+        with self.lock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            try:
+                session.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def stop(self):
+        try:
+            # wake up the blocking accept()
+            self.server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server.close()
+        self.drop_clients()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+'''
+Minimal Laporte Socket.IO server for benchmarks
+'''
+
+import json
+import logging
+import threading
+from time import monotonic
+import socketio
+from werkzeug.serving import make_server
+
+METRICS_NAMESPACE = '/metrics'
+
+
+class FakeLaporte():
+    '''
+    Socket.IO server joining gateway rooms, recording sensor_addr_response
+    emits and sending actuator_addr_response commands
+    '''
+    def __init__(self, host='127.0.0.1', port=0, on_sensor=None):
+        self.sio = socketio.Server(async_mode='threading')
+        self.received = []
+        self.rooms = []
+        self.on_sensor_callback = on_sensor
+        self.sio.on('sensor_addr_response', self.on_sensor, namespace=METRICS_NAMESPACE)
+        self.sio.on('join', self.on_join, namespace=METRICS_NAMESPACE)
+        self.server = make_server(host, port, socketio.WSGIApp(self.sio), threaded=True)
+        self.host, self.port = host, self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def on_sensor(self, sid, message):
+        '''record an emit of sensor values'''
+
+        del sid  # Ignored parameter
+        now = monotonic()
+        if self.on_sensor_callback is None:
+            self.received.append((now, message))
+        else:
+            self.on_sensor_callback(now, message)
+        return True
+
+    def on_join(self, sid, message):
+        '''join a gateway room'''
+
+        self.rooms.append(message['room'])
+        self.sio.enter_room(sid, message['room'], namespace=METRICS_NAMESPACE)
+
+    def actuator(self, gateway, node_addr, keys):
+        '''send an actuator change to the gateway room'''
+
+        self.sio.emit('actuator_addr_response',
+                      json.dumps({gateway: {node_addr: keys}}),
+                      namespace=METRICS_NAMESPACE,
+                      to=gateway)
+
+    def stop(self):
+        self.server.shutdown()
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+'''
+Asyncio runtime: MQTT and Laporte Socket.IO clients on one event loop
+'''
+
+import asyncio
+import logging
+import json
+import socketio
+import paho.mqtt.client as mqtt
+from laporte.client.metrics import (laporte_emits_total, laporte_responses_total,
+                                    laporte_connects_total)
+from laporte.client.sio import METRICS_NAMESPACE
+from laporte_mqtt.mqtt import Mqqt
+from laporte_mqtt.laporte import Laporte
+from laporte_mqtt.msglog import message_log
+from laporte_mqtt.metrics import mqtt_reconnect_attempts_total, observe_stamps
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+LAPORTE_CONNECT_DELAY = 10
+
+
+class DefaultNamespace(socketio.AsyncClientNamespace):
+    '''Socket.IO event handlers for default responses'''
+    @staticmethod
+    def on_connect():
+        logging.info("Laporte connected OK")
+        laporte_connects_total.labels('laporte').inc()
+
+    @staticmethod
+    def on_disconnect():
+        logging.info("Laporte disconnected")
+
+    @staticmethod
+    def on_status_response(data):
+        laporte_responses_total.labels('status_response', '/').inc()
+        logging.info("Laporte status response: %s", data)
+
+
+class MetricsNamespace(socketio.AsyncClientNamespace):
+    '''Socket.IO event handlers for metrics of the joined gateways'''
+    def __init__(self, namespace, gateways, actuator_addr_handler):
+        socketio.AsyncClientNamespace.__init__(self, namespace)
+        self.gateways = gateways
+        self.actuator_addr_handler = actuator_addr_handler
+
+    async def on_connect(self):
+        '''join Socket.IO rooms called as same as gateways'''
+
+        for gw_name in self.gateways:
+            await self.emit("join", {'room': gw_name})
+
+    def on_actuator_addr_response(self, data):
+        '''receive metrics of changed actuators identified by node_addr/key'''
+
+        laporte_responses_total.labels('actuator_addr_response', METRICS_NAMESPACE).inc()
+        for gateway, nodes in json.loads(data).items():
+            for node_addr, keys in nodes.items():
+                self.actuator_addr_handler(gateway, node_addr, keys)
+
+    @staticmethod
+    def on_config_response(data):
+        laporte_responses_total.labels('config_response', METRICS_NAMESPACE).inc()
+        logging.debug("Laporte config response for %s", next(iter(data)))
+
+    @staticmethod
+    def on_status_response(data):
+        laporte_responses_total.labels('status_response', METRICS_NAMESPACE).inc()
+        logging.info("Laporte %s namespace status response: %s", METRICS_NAMESPACE, data)
+
+
+class AsyncLaporte():
+    '''
+    Laporte client using the asyncio Socket.IO client,
+    emits are scheduled as concurrent tasks of the event loop.
+    '''
+
+    publish_actuator = Laporte.publish_actuator
+
+    def __init__(self, gateways: list) -> None:
+        self.mqtt = None
+        self.loop = None
+        self.tasks = set()
+        self.sio = socketio.AsyncClient()
+        self.sio.register_namespace(DefaultNamespace('/'))
+        self.ns_metrics = MetricsNamespace(METRICS_NAMESPACE, gateways,
+                                           self.publish_actuator)
+        self.sio.register_namespace(self.ns_metrics)
+
+    async def connect(self, addr: str, port: int):
+        '''connect to the laporte server, Socket.IO client reconnects itself then'''
+
+        self.loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await self.sio.connect(f'http://{addr}:{port}',
+                                       namespaces=[METRICS_NAMESPACE])
+            except socketio.exceptions.ConnectionError as exc:
+                logging.error("%s", exc)
+                await asyncio.sleep(LAPORTE_CONNECT_DELAY)
+            else:
+                break
+
+    def is_connected(self) -> bool:
+        '''check the metrics namespace is connected'''
+
+        return self.sio.connected and METRICS_NAMESPACE in self.sio.namespaces
+
+    async def disconnect(self) -> None:
+        '''send scheduled emits and disconnect from the Laporte server'''
+
+        if self.tasks:
+            await asyncio.wait(list(self.tasks))
+        await self.sio.disconnect()
+
+    def join_gateways(self, gateways: list) -> None:
+        '''join Laporte rooms of gateways added by a config reload'''
+
+        joined = self.ns_metrics.gateways
+        self.ns_metrics.gateways = gateways
+        if not self.sio.connected:
+            return
+        for gw_name in gateways:
+            if gw_name not in joined:
+                task = self.loop.create_task(self.ns_metrics.emit("join", {'room': gw_name}))
+                self.tasks.add(task)
+                task.add_done_callback(self._emitted)
+
+    def _emitted(self, task):
+        '''finish an emit task'''
+
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Laporte emit failed: %s", task.exception())
+
+    async def send(self, response, message, namespace, callback, stamps):
+        '''emit on the event loop, observe latencies of stamps as it is sent'''
+
+        await self.sio.emit(response, message, namespace=namespace, callback=callback)
+        observe_stamps(stamps)
+
+    def emit(self, response, message, namespace=METRICS_NAMESPACE, callback=None, stamps=None):
+        '''
+        emit custom response to the Laporte (from any thread),
+        callback is called upon its acknowledgement
+        '''
+
+        message_log.info(response, "Laporte emit: %s %s", response, message)
+        laporte_emits_total.labels(response, namespace).inc()
+        coro = self.send(response, message, namespace, callback, stamps)
+
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if running is self.loop:
+            task = self.loop.create_task(coro)
+            self.tasks.add(task)
+            task.add_done_callback(self._emitted)
+        else:
+            asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+class AsyncMqqt(Mqqt):
+    '''
+    MQTT client driven by the event loop through paho external socket hooks,
+    reconnects are triggered by the disconnect event instead of polling.
+    '''
+    def __init__(self, gateways, laporte, **kwargs) -> None:
+        Mqqt.__init__(self, gateways, laporte, **kwargs)
+        self.loop = None
+        self.misc = None
+        self.disconnected = None
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        del client, userdata  # Ignored parameters
+        self.loop.add_reader(sock, self.client.loop_read)
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        del client, userdata  # Ignored parameters
+        self.loop.remove_reader(sock)
+        if self.misc is not None:
+            self.misc.cancel()
+            self.misc = None
+
+    def on_socket_register_write(self, client, userdata, sock):
+        del client, userdata  # Ignored parameters
+        self.loop.add_writer(sock, self.client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        del client, userdata  # Ignored parameters
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        '''keepalive and retry handling of paho'''
+
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    def on_disconnect(self, _, userdata, ret):
+        Mqqt.on_disconnect(self, _, userdata, ret)
+        self.disconnected.set()
+
+    async def reconnect(self):
+        '''reconnect with exponential backoff and jitter'''
+
+        nattempts = 0
+        while self.running:
+            await asyncio.sleep(self.backoff.next())
+            nattempts += 1
+            mqtt_reconnect_attempts_total.inc()
+            try:
+                self.client.reconnect()
+            except (ConnectionRefusedError, OSError) as exc:
+                logging.error("MQTT reconnect failed (attempt=%s): %s", nattempts, exc)
+            else:
+                return
+
+    def stop(self):
+        Mqqt.stop(self)
+        self.disconnected.set()
+
+    async def run(self, host: str, port: int, keepalive=30, required=True):
+        '''connect to the broker and keep the connection'''
+
+        self.loop = asyncio.get_running_loop()
+        self.disconnected = asyncio.Event()
+        if not self.connect(host, port, keepalive, required):
+            self.disconnected.set()
+
+        while True:
+            await self.disconnected.wait()
+            self.disconnected.clear()
+            if not self.running:
+                return
+            await self.reconnect()
+
+
+async def watch_config(reloader, interval: float):
+    '''check the gateways config file for modifications forever'''
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            reloader.check()
+        except Exception as exc:  # pylint: disable=broad-except
+            logging.error("gateways config reload failed: %s", exc)
@@ -3,21 +3,60 @@
 
 import logging
 import os
-from argparse import ArgumentParser, ArgumentTypeError
+from argparse import Action, ArgumentParser, ArgumentTypeError, SUPPRESS
 from laporte_mqtt.version import __version__, app_name, get_runtime_info
+from laporte_mqtt.policies import POLICIES, FLOW_POLICIES, POLICY_BLOCK, POLICY_COALESCE
 
 # default parameters
 LOG_LEVEL_STRINGS = ['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG']
 LOG_LEVEL_DEFAULT = 'INFO'
 LOG_VERBOSE_DEFAULT = False
+LOG_ASYNC_DEFAULT = False
+LOG_TOPIC_RATE_DEFAULT = 0
+LOG_SUMMARY_INTERVAL_DEFAULT = 0
 LAPORTE_HOST_DEFAULT = '127.0.0.1'
 LAPORTE_PORT_DEFAULT = 1883
 MQTT_BROKER_HOST_DEFAULT = '127.0.0.1'
 MQTT_BROKER_PORT_DEFAULT = 1883
 MQTT_KEEPALIVE_DEFAULT = 30
+MQTT_MAX_INFLIGHT_DEFAULT = 20
+MQTT_MAX_QUEUED_DEFAULT = 0
+MQTT_OUTBOX_SIZE_DEFAULT = 1000
+MQTT_RECONNECT_DELAY_MIN_DEFAULT = 1.0
+MQTT_RECONNECT_DELAY_MAX_DEFAULT = 60.0
+MQTT_RECONNECT_JITTER_DEFAULT = 0.5
+MQTT_PERSISTENT_SESSION_DEFAULT = False
+MQTT_CLIENT_ID_DEFAULT = ''
+MQTT_SUBSCRIBE_QOS_DEFAULT = 0
+MQTT_WARMUP_QUIET_DEFAULT = 0.2
+MQTT_WARMUP_MAX_DEFAULT = 10.0
 CONFIG_FILE_DEFAULT = 'conf/gateways.yml'
+CONFIG_RELOAD_INTERVAL_DEFAULT = 0
 LISTEN_ADDR_DEFAULT = '0.0.0.0'
 LISTEN_PORT_DEFAULT = 9129
+PROFILE_ENDPOINT_DEFAULT = False
+EMIT_BATCH_WINDOW_DEFAULT = 0
+EMIT_BATCH_SIZE_DEFAULT = 100
+EMIT_ACK_WINDOW_DEFAULT = 0
+EMIT_ACK_POLICY_DEFAULT = POLICY_COALESCE
+EMIT_ACK_TIMEOUT_DEFAULT = 10.0
+INGEST_WORKERS_DEFAULT = 1
+INGEST_QUEUE_SIZE_DEFAULT = 10000
+INGEST_POLICY_DEFAULT = POLICY_BLOCK
+DEDUP_MAX_AGE_DEFAULT = 0
+DEDUP_CACHE_SIZE_DEFAULT = 100000
+SPOOL_DIR_DEFAULT = ''
+SPOOL_MAX_SIZE_DEFAULT = 64
+SPOOL_REPLAY_RATE_DEFAULT = 100
+SPOOL_COMPACT_DEFAULT = False
+CAPTURE_FILE_DEFAULT = ''
+CAPTURE_MAX_SIZE_DEFAULT = 100
+ENGINE_THREADS = 'threads'
+ENGINE_ASYNCIO = 'asyncio'
+ENGINES = [ENGINE_THREADS, ENGINE_ASYNCIO]
+ENGINE_DEFAULT = ENGINE_THREADS
+WORKERS_DEFAULT = 0
+SHARE_GROUP_DEFAULT = app_name
 
 
 def log_level_string_to_int(arg_string: str) -> int:
@@ -36,7 +75,17 @@ def log_level_string_to_int(arg_string: str) -> int:
     return log_level_int
 
 
-def get_pars():
+class RuntimeInfoAction(Action):
+    '''print the app and modules versions (gathered only when asked for) and exit'''
+    def __init__(self, option_strings, dest=SUPPRESS, default=SUPPRESS, help=None):
+        # pylint: disable=redefined-builtin
+        super().__init__(option_strings, dest=dest, default=default, nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        parser.exit(message=f'{get_runtime_info()}\n')
+
+
+def get_pars(argv: list = None):
     '''
     get parameters from from command line arguments
     defaults overriden by ENVs
@@ -58,21 +107,126 @@ def get_pars():
         'MQTT_KEEPALIVE': {
             'default': MQTT_KEEPALIVE_DEFAULT
         },
+        'MQTT_MAX_INFLIGHT': {
+            'default': MQTT_MAX_INFLIGHT_DEFAULT
+        },
+        'MQTT_MAX_QUEUED': {
+            'default': MQTT_MAX_QUEUED_DEFAULT
+        },
+        'MQTT_OUTBOX_SIZE': {
+            'default': MQTT_OUTBOX_SIZE_DEFAULT
+        },
+        'MQTT_RECONNECT_DELAY_MIN': {
+            'default': MQTT_RECONNECT_DELAY_MIN_DEFAULT
+        },
+        'MQTT_RECONNECT_DELAY_MAX': {
+            'default': MQTT_RECONNECT_DELAY_MAX_DEFAULT
+        },
+        'MQTT_RECONNECT_JITTER': {
+            'default': MQTT_RECONNECT_JITTER_DEFAULT
+        },
+        'MQTT_PERSISTENT_SESSION': {
+            'default': MQTT_PERSISTENT_SESSION_DEFAULT
+        },
+        'MQTT_CLIENT_ID': {
+            'default': MQTT_CLIENT_ID_DEFAULT
+        },
+        'MQTT_SUBSCRIBE_QOS': {
+            'default': MQTT_SUBSCRIBE_QOS_DEFAULT
+        },
+        'MQTT_WARMUP_QUIET': {
+            'default': MQTT_WARMUP_QUIET_DEFAULT
+        },
+        'MQTT_WARMUP_MAX': {
+            'default': MQTT_WARMUP_MAX_DEFAULT
+        },
         'CONFIG_FILE': {
             'default': CONFIG_FILE_DEFAULT
         },
+        'CONFIG_RELOAD_INTERVAL': {
+            'default': CONFIG_RELOAD_INTERVAL_DEFAULT
+        },
         'LISTEN_ADDR': {
             'default': LISTEN_ADDR_DEFAULT
         },
         'LISTEN_PORT': {
             'default': LISTEN_PORT_DEFAULT
         },
+        'PROFILE_ENDPOINT': {
+            'default': PROFILE_ENDPOINT_DEFAULT
+        },
+        'EMIT_BATCH_WINDOW': {
+            'default': EMIT_BATCH_WINDOW_DEFAULT
+        },
+        'EMIT_BATCH_SIZE': {
+            'default': EMIT_BATCH_SIZE_DEFAULT
+        },
+        'EMIT_ACK_WINDOW': {
+            'default': EMIT_ACK_WINDOW_DEFAULT
+        },
+        'EMIT_ACK_POLICY': {
+            'default': EMIT_ACK_POLICY_DEFAULT
+        },
+        'EMIT_ACK_TIMEOUT': {
+            'default': EMIT_ACK_TIMEOUT_DEFAULT
+        },
+        'INGEST_WORKERS': {
+            'default': INGEST_WORKERS_DEFAULT
+        },
+        'INGEST_QUEUE_SIZE': {
+            'default': INGEST_QUEUE_SIZE_DEFAULT
+        },
+        'INGEST_POLICY': {
+            'default': INGEST_POLICY_DEFAULT
+        },
+        'DEDUP_MAX_AGE': {
+            'default': DEDUP_MAX_AGE_DEFAULT
+        },
+        'DEDUP_CACHE_SIZE': {
+            'default': DEDUP_CACHE_SIZE_DEFAULT
+        },
+        'SPOOL_DIR': {
+            'default': SPOOL_DIR_DEFAULT
+        },
+        'SPOOL_MAX_SIZE': {
+            'default': SPOOL_MAX_SIZE_DEFAULT
+        },
+        'SPOOL_REPLAY_RATE': {
+            'default': SPOOL_REPLAY_RATE_DEFAULT
+        },
+        'SPOOL_COMPACT': {
+            'default': SPOOL_COMPACT_DEFAULT
+        },
+        'CAPTURE_FILE': {
+            'default': CAPTURE_FILE_DEFAULT
+        },
+        'CAPTURE_MAX_SIZE': {
+            'default': CAPTURE_MAX_SIZE_DEFAULT
+        },
+        'ENGINE': {
+            'default': ENGINE_DEFAULT
+        },
+        'WORKERS': {
+            'default': WORKERS_DEFAULT
+        },
+        'SHARE_GROUP': {
+            'default': SHARE_GROUP_DEFAULT
+        },
         'LOG_LEVEL': {
             'default': LOG_LEVEL_DEFAULT
         },
         'LOG_VERBOSE': {
             'default': LOG_VERBOSE_DEFAULT
         },
+        'LOG_ASYNC': {
+            'default': LOG_ASYNC_DEFAULT
+        },
+        'LOG_TOPIC_RATE': {
+            'default': LOG_TOPIC_RATE_DEFAULT
+        },
+        'LOG_SUMMARY_INTERVAL': {
+            'default': LOG_SUMMARY_INTERVAL_DEFAULT
+        },
     }
 
     # defaults overriden from ENVs
@@ -129,6 +283,89 @@ def get_pars():
                               f'(default {MQTT_KEEPALIVE_DEFAULT})'),
                         type=int,
                         **env_vars['MQTT_KEEPALIVE'])
+    parser.add_argument('--mqtt-max-inflight',
+                        action='store',
+                        dest='mqtt_max_inflight',
+                        help=('max count of QoS>0 MQTT messages in flight at once '
+                              f'(default {MQTT_MAX_INFLIGHT_DEFAULT})'),
+                        type=int,
+                        **env_vars['MQTT_MAX_INFLIGHT'])
+    parser.add_argument('--mqtt-max-queued',
+                        action='store',
+                        dest='mqtt_max_queued',
+                        help=('max count of outgoing MQTT messages queued in the client; '
+                              f'0 is unlimited (default {MQTT_MAX_QUEUED_DEFAULT})'),
+                        type=int,
+                        **env_vars['MQTT_MAX_QUEUED'])
+    parser.add_argument('--mqtt-outbox-size',
+                        action='store',
+                        dest='mqtt_outbox_size',
+                        help=('max count of actuator publishes (the latest per topic) '
+                              'queued while MQTT broker is disconnected; 0 leaves them '
+                              f'to the MQTT client (default {MQTT_OUTBOX_SIZE_DEFAULT})'),
+                        type=int,
+                        **env_vars['MQTT_OUTBOX_SIZE'])
+    parser.add_argument('--mqtt-reconnect-delay-min',
+                        action='store',
+                        dest='mqtt_reconnect_delay_min',
+                        help=('delay in seconds before the first MQTT reconnect attempt, '
+                              'doubled with each failed one '
+                              f'(default {MQTT_RECONNECT_DELAY_MIN_DEFAULT})'),
+                        type=float,
+                        **env_vars['MQTT_RECONNECT_DELAY_MIN'])
+    parser.add_argument('--mqtt-reconnect-delay-max',
+                        action='store',
+                        dest='mqtt_reconnect_delay_max',
+                        help=('max delay in seconds between MQTT reconnect attempts '
+                              f'(default {MQTT_RECONNECT_DELAY_MAX_DEFAULT})'),
+                        type=float,
+                        **env_vars['MQTT_RECONNECT_DELAY_MAX'])
+    parser.add_argument('--mqtt-reconnect-jitter',
+                        action='store',
+                        dest='mqtt_reconnect_jitter',
+                        help=('max fraction of a reconnect delay randomly cut off '
+                              f'(default {MQTT_RECONNECT_JITTER_DEFAULT})'),
+                        type=float,
+                        **env_vars['MQTT_RECONNECT_JITTER'])
+    parser.add_argument('--mqtt-persistent-session',
+                        action='store_true',
+                        dest='mqtt_persistent_session',
+                        help=('keep the MQTT session on the broker between connections '
+                              '(clean_session=False with a stable client id), '
+                              'QoS>0 messages are queued by the broker meanwhile'),
+                        **env_vars['MQTT_PERSISTENT_SESSION'])
+    parser.add_argument('--mqtt-client-id',
+                        action='store',
+                        dest='mqtt_client_id',
+                        help=('MQTT client id; empty means a random one or '
+                              f'{app_name}_<hostname> with a persistent session '
+                              f"(default '{MQTT_CLIENT_ID_DEFAULT}')"),
+                        type=str,
+                        **env_vars['MQTT_CLIENT_ID'])
+    parser.add_argument('--mqtt-subscribe-qos',
+                        action='store',
+                        dest='mqtt_subscribe_qos',
+                        help=('QoS of MQTT subscriptions '
+                              f'(default {MQTT_SUBSCRIBE_QOS_DEFAULT})'),
+                        choices=[0, 1, 2],
+                        type=int,
+                        **env_vars['MQTT_SUBSCRIBE_QOS'])
+    parser.add_argument('--mqtt-warmup-quiet',
+                        action='store',
+                        dest='mqtt_warmup_quiet',
+                        help=('seconds without a retained message ending the warmup '
+                              'after a subscribe is acknowledged '
+                              f'(default {MQTT_WARMUP_QUIET_DEFAULT})'),
+                        type=float,
+                        **env_vars['MQTT_WARMUP_QUIET'])
+    parser.add_argument('--mqtt-warmup-max',
+                        action='store',
+                        dest='mqtt_warmup_max',
+                        help=('max seconds to collect retained messages after a subscribe '
+                              'into bulk snapshot emits, 0 = emit them one by one '
+                              f'(default {MQTT_WARMUP_MAX_DEFAULT})'),
+                        type=float,
+                        **env_vars['MQTT_WARMUP_MAX'])
     parser.add_argument('-c',
                         '--gateways-config-file',
                         action='store',
@@ -137,6 +374,14 @@ def get_pars():
                               f"gateways configuration (default {CONFIG_FILE_DEFAULT})"),
                         type=str,
                         **env_vars['CONFIG_FILE'])
+    parser.add_argument('--config-reload-interval',
+                        action='store',
+                        dest='config_reload_interval',
+                        help=('check gateways config file for changes every given '
+                              'seconds and reload it; 0 reloads on SIGHUP only '
+                              f'(default {CONFIG_RELOAD_INTERVAL_DEFAULT})'),
+                        type=int,
+                        **env_vars['CONFIG_RELOAD_INTERVAL'])
     parser.add_argument('-a',
                         '--exporter-listen-address',
                         action='store',
@@ -153,10 +398,169 @@ def get_pars():
                               f'(default {LISTEN_PORT_DEFAULT})'),
                         type=int,
                         **env_vars['LISTEN_PORT'])
+    parser.add_argument('--profile-endpoint',
+                        action='store_true',
+                        dest='profile_endpoint',
+                        help=('serve a stack sampling profile of all threads at '
+                              '/profile?seconds=N of the metrics port (folded stacks)'),
+                        **env_vars['PROFILE_ENDPOINT'])
+    parser.add_argument('-w',
+                        '--emit-batch-window',
+                        action='store',
+                        dest='emit_batch_window',
+                        help=('merge sensor messages arriving within a window '
+                              'of milliseconds into one Laporte emit; 0 disables '
+                              f'batching (default {EMIT_BATCH_WINDOW_DEFAULT})'),
+                        type=int,
+                        **env_vars['EMIT_BATCH_WINDOW'])
+    parser.add_argument('-n',
+                        '--emit-batch-size',
+                        action='store',
+                        dest='emit_batch_size',
+                        help=('max count of sensor messages merged into one '
+                              f'Laporte emit (default {EMIT_BATCH_SIZE_DEFAULT})'),
+                        type=int,
+                        **env_vars['EMIT_BATCH_SIZE'])
+    parser.add_argument('--emit-ack-window',
+                        action='store',
+                        dest='emit_ack_window',
+                        help=('max count of Laporte emits waiting for an acknowledgement; '
+                              f'0 disables flow control (default {EMIT_ACK_WINDOW_DEFAULT})'),
+                        type=int,
+                        **env_vars['EMIT_ACK_WINDOW'])
+    parser.add_argument('--emit-ack-policy',
+                        action='store',
+                        dest='emit_ack_policy',
+                        help=('what to do with emits while the ack window is full '
+                              f'{FLOW_POLICIES}; block holds back MQTT processing, '
+                              'coalesce merges pending values '
+                              f'(default {EMIT_ACK_POLICY_DEFAULT})'),
+                        choices=FLOW_POLICIES,
+                        type=str,
+                        **env_vars['EMIT_ACK_POLICY'])
+    parser.add_argument('--emit-ack-timeout',
+                        action='store',
+                        dest='emit_ack_timeout',
+                        help=('seconds after which an unacknowledged emit leaves the '
+                              f'ack window (default {EMIT_ACK_TIMEOUT_DEFAULT})'),
+                        type=float,
+                        **env_vars['EMIT_ACK_TIMEOUT'])
+    parser.add_argument('--ingest-workers',
+                        action='store',
+                        dest='ingest_workers',
+                        help=('count of threads processing received MQTT messages; '
+                              '0 processes them in the MQTT network thread, messages '
+                              'of one topic are processed by one thread in order '
+                              f'(default {INGEST_WORKERS_DEFAULT})'),
+                        type=int,
+                        **env_vars['INGEST_WORKERS'])
+    parser.add_argument('--ingest-queue-size',
+                        action='store',
+                        dest='ingest_queue_size',
+                        help=('max count of received MQTT messages waiting for '
+                              f'processing (default {INGEST_QUEUE_SIZE_DEFAULT})'),
+                        type=int,
+                        **env_vars['INGEST_QUEUE_SIZE'])
+    parser.add_argument('--ingest-policy',
+                        action='store',
+                        dest='ingest_policy',
+                        help=('what to do when the ingest queue is full '
+                              f'{POLICIES} (default {INGEST_POLICY_DEFAULT})'),
+                        choices=POLICIES,
+                        type=str,
+                        **env_vars['INGEST_POLICY'])
+    parser.add_argument('--dedup-max-age',
+                        action='store',
+                        dest='dedup_max_age',
+                        help=('forward an unchanged sensor value at most once per '
+                              'given seconds; 0 forwards every value '
+                              f'(default {DEDUP_MAX_AGE_DEFAULT})'),
+                        type=int,
+                        **env_vars['DEDUP_MAX_AGE'])
+    parser.add_argument('--dedup-cache-size',
+                        action='store',
+                        dest='dedup_cache_size',
+                        help=('max count of sensor values kept to detect changes '
+                              f'(default {DEDUP_CACHE_SIZE_DEFAULT})'),
+                        type=int,
+                        **env_vars['DEDUP_CACHE_SIZE'])
+    parser.add_argument('--spool-dir',
+                        action='store',
+                        dest='spool_dir',
+                        help=('directory to spool sensor data while Laporte is '
+                              'unreachable; empty disables spooling '
+                              f"(default '{SPOOL_DIR_DEFAULT}')"),
+                        type=str,
+                        **env_vars['SPOOL_DIR'])
+    parser.add_argument('--spool-max-size',
+                        action='store',
+                        dest='spool_max_size',
+                        help=('max size of spooled data in MiB, the oldest data are '
+                              f'dropped above (default {SPOOL_MAX_SIZE_DEFAULT})'),
+                        type=int,
+                        **env_vars['SPOOL_MAX_SIZE'])
+    parser.add_argument('--spool-replay-rate',
+                        action='store',
+                        dest='spool_replay_rate',
+                        help=('max count of spooled emits replayed per second; '
+                              f'0 is unlimited (default {SPOOL_REPLAY_RATE_DEFAULT})'),
+                        type=int,
+                        **env_vars['SPOOL_REPLAY_RATE'])
+    parser.add_argument('--spool-compact',
+                        action='store_true',
+                        dest='spool_compact',
+                        help='replay only the latest spooled value of each node/key',
+                        **env_vars['SPOOL_COMPACT'])
+    parser.add_argument('--capture-file',
+                        action='store',
+                        dest='capture_file',
+                        help=('write received MQTT messages to a binary capture file '
+                              'for laporte-mqtt-replay; empty disables capturing '
+                              f"(default '{CAPTURE_FILE_DEFAULT}')"),
+                        type=str,
+                        **env_vars['CAPTURE_FILE'])
+    parser.add_argument('--capture-max-size',
+                        action='store',
+                        dest='capture_max_size',
+                        help=('max size of the capture file in MiB, capturing stops '
+                              f'above (default {CAPTURE_MAX_SIZE_DEFAULT})'),
+                        type=int,
+                        **env_vars['CAPTURE_MAX_SIZE'])
+    parser.add_argument('-e',
+                        '--engine',
+                        action='store',
+                        dest='engine',
+                        help=('runtime of MQTT and Socket.IO clients '
+                              f'{ENGINES}; asyncio runs both on one event loop '
+                              f'and needs aiohttp (default {ENGINE_DEFAULT})'),
+                        choices=ENGINES,
+                        type=str,
+                        **env_vars['ENGINE'])
+    parser.add_argument('--workers',
+                        action='store',
+                        dest='workers',
+                        help=('start given count of worker processes subscribed '
+                              'with MQTT shared subscriptions; 0 runs a single '
+                              f'process (default {WORKERS_DEFAULT})'),
+                        type=int,
+                        **env_vars['WORKERS'])
+    parser.add_argument('--share-group',
+                        action='store',
+                        dest='share_group',
+                        help=('group name of MQTT shared subscriptions used by '
+                              f'workers (default {SHARE_GROUP_DEFAULT})'),
+                        type=str,
+                        **env_vars['SHARE_GROUP'])
+    parser.add_argument('--worker-id',
+                        action='store',
+                        dest='worker_id',
+                        help=SUPPRESS,
+                        type=int,
+                        default=-1)
     parser.add_argument('-V',
                         '--version',
-                        action='version',
-                        version=str(get_runtime_info()))
+                        action=RuntimeInfoAction,
+                        help="show program's version number and exit")
     parser.add_argument('-l',
                         '--log-level',
                         action='store',
@@ -173,9 +577,24 @@ def get_pars():
                         help='most verbose debug level '
                         '(console only; useful for a bug hunt :)',
                         **env_vars['LOG_VERBOSE'])
+    parser.add_argument('--log-async',
+                        action='store_true',
+                        dest='log_async',
+                        help='format and write log records in a background thread',
+                        **env_vars['LOG_ASYNC'])
+    parser.add_argument('--log-topic-rate',
+                        action='store',
+                        dest='log_topic_rate',
+                        help=('max count of per-message log lines per topic and minute; '
+                              f'0 is unlimited (default {LOG_TOPIC_RATE_DEFAULT})'),
+                        type=int,
+                        **env_vars['LOG_TOPIC_RATE'])
+    parser.add_argument('--log-summary-interval',
+                        action='store',
+                        dest='log_summary_interval',
+                        help=('log a summary of msgs/s per gateway every given seconds; '
+                              f'0 disables it (default {LOG_SUMMARY_INTERVAL_DEFAULT})'),
+                        type=int,
+                        **env_vars['LOG_SUMMARY_INTERVAL'])
 
-    return parser.parse_args()
-
-
-# get parameters from command line arguments
-pars = get_pars()
+    return parser.parse_args(argv)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+'''
+Exponential backoff with jitter of reconnect attempts
+'''
+
+import logging
+import random
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+class Backoff():
+    '''
+    Delays of reconnect attempts doubling from delay_min up to delay_max,
+    each one shortened by a random fraction up to jitter, so a fleet of
+    clients does not hit a restarted broker at once.
+    '''
+    def __init__(self, delay_min: float = 1, delay_max: float = 60, jitter: float = 0.5):
+        self.delay_min = delay_min
+        self.delay_max = delay_max
+        self.jitter = min(max(jitter, 0), 1)
+        self.delay = delay_min
+
+    def reset(self) -> None:
+        '''start again from the shortest delay (after a successful connect)'''
+
+        self.delay = self.delay_min
+
+    def next(self) -> float:
+        '''return a delay of the next attempt'''
+
+        ret = self.delay * (1 - self.jitter * random.random())
+        self.delay = min(self.delay * 2, self.delay_max)
+        return ret
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+'''
+Micro-batching of emits to Laporte
+'''
+
+import logging
+import threading
+from time import monotonic
+from laporte_mqtt.metrics import emit_batch_entries
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+def merge_nodes(batch, message):
+    '''merge a {node: {key: value}} message into a batch'''
+
+    for node, value in message.items():
+        current = batch.get(node)
+        if isinstance(current, dict) and isinstance(value, dict):
+            current.update(value)
+        elif isinstance(value, dict):
+            batch[node] = dict(value)
+        else:
+            batch[node] = value
+
+
+class EmitBatcher():
+    '''
+    Merge messages emitted within a time window (or up to max_entries
+    messages) into one {node: {key: value, ...}, ...} emit of the target.
+    The window starts with the first message of a batch, so no message
+    waits longer than the window.
+    '''
+    def __init__(self, target, window=0.02, max_entries=100):
+        self.target = target
+        self.window = window
+        self.max_entries = max_entries
+        self.pending = {}
+        self.stamps = {}
+        self.entries = 0
+        self.deadline = None
+        self.running = True
+        self.cond = threading.Condition()
+        # one batch is detached and emitted at a time, so batches keep order
+        self.emit_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def emit(self, response, message, stamps=None):
+        '''add a message (and stamps of its MQTT messages) to the current batch'''
+
+        with self.cond:
+            merge_nodes(self.pending.setdefault(response, {}), message)
+            if stamps:
+                self.stamps.setdefault(response, []).extend(stamps)
+            self.entries += 1
+            if self.deadline is None:
+                self.deadline = monotonic() + self.window
+                self.cond.notify()
+            if self.entries < self.max_entries:
+                return
+
+        self.flush()
+
+    def _take(self):
+        '''detach pending batch (call with the lock held)'''
+
+        batch = (self.pending, self.stamps, self.entries)
+        self.pending = {}
+        self.stamps = {}
+        self.entries = 0
+        self.deadline = None
+        return batch
+
+    def _emit(self, batch):
+        '''emit detached batch to the target'''
+
+        pending, stamps, entries = batch
+        if not pending:
+            return
+        emit_batch_entries.observe(entries)
+        for response, message in pending.items():
+            self.target.emit(response, message, stamps=stamps.get(response))
+
+    def flush(self):
+        '''emit pending batch immediately'''
+
+        with self.emit_lock:
+            with self.cond:
+                batch = self._take()
+            self._emit(batch)
+
+    def stop(self):
+        '''finish the loop and emit the pending batch'''
+
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+        self.flush()
+
+    def loop(self):
+        '''emit batches when their window elapses until stop()'''
+
+        while True:
+            with self.cond:
+                while self.deadline is None and self.running:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                timeout = self.deadline - monotonic()
+                if timeout > 0:
+                    self.cond.wait(timeout)
+                    continue
+
+            try:
+                self.flush()
+            except Exception as exc:  # pylint: disable=broad-except
+                logging.error("emit batch failed: %s", exc)
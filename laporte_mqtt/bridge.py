@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+'''
+Embeddable MQTT bridge for Laporte
+'''
+
+import os
+import socket
+import logging
+import threading
+from laporte_mqtt.argparser import get_pars
+from laporte_mqtt.policies import POLICY_BLOCK, POLICY_COALESCE
+from laporte_mqtt.version import app_name, app_instance
+
+# pylint: disable=import-outside-toplevel
+# client modules (paho, Socket.IO, prometheus, yaml) are imported as a bridge
+# starts, so importing this module and creating a bridge is cheap
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+class Bridge():
+    '''
+    MQTT clients of the gateways brokers, the Laporte Socket.IO client and
+    the emit stages between them, configured by cmd line options parsed
+    with get_pars() (defaults if None). The gateways config is loaded from
+    the config file unless given. Run it either in threads by start() or on
+    the running event loop by run(), stop() disconnects the clients and
+    finishes threads of the emit stages, flushing their buffers.
+    Prometheus metrics are shared by all bridges of a process.
+    '''
+    def __init__(self, pars=None, gateways=None) -> None:
+        self.pars = get_pars([]) if pars is None else pars
+        self.gateways = gateways
+        self.laporte = None
+        self.mqtt = None
+        self.reloader = None
+        self.thread = None
+        # emit stages, innermost first
+        self.stages = []
+        self.capture = None
+        self.summary = None
+        self.ingest_workers = None
+        self.watch = None
+
+    def load_gateways(self):
+        '''return the gateways config, loaded from the config file the first time'''
+
+        from laporte_mqtt.config import GatewaysConfig
+
+        if self.gateways is None:
+            self.gateways = GatewaysConfig(self.pars.config_file)
+        return self.gateways
+
+    def create_sink(self, laporte):
+        '''wrap the laporte client into configured emit stages'''
+
+        from laporte_mqtt.flow import AckWindow
+        from laporte_mqtt.spool import Spool
+        from laporte_mqtt.batcher import EmitBatcher
+
+        pars = self.pars
+        sink = laporte
+
+        # limit emits waiting for a Laporte acknowledgement
+        if pars.emit_ack_window > 0:
+            policy = pars.emit_ack_policy
+            # (no thread of the Socket.IO loop in the event loop runtime)
+            if policy == POLICY_BLOCK and self.thread is None:
+                # acknowledgements are received by the blocked event loop
+                logging.warning("emit ack policy %s not supported by asyncio engine, using %s",
+                                policy, POLICY_COALESCE)
+                policy = POLICY_COALESCE
+            sink = AckWindow(sink,
+                             window=pars.emit_ack_window,
+                             policy=policy,
+                             timeout=pars.emit_ack_timeout)
+            self.stages.append(sink)
+
+        # spool sensor emits while laporte is unreachable
+        if pars.spool_dir:
+            spool_dir = pars.spool_dir
+            if pars.worker_id >= 0:
+                spool_dir = os.path.join(spool_dir, f'worker-{pars.worker_id}')
+            sink = Spool(sink,
+                         spool_dir,
+                         max_bytes=pars.spool_max_size * 2**20,
+                         replay_rate=pars.spool_replay_rate,
+                         compact=pars.spool_compact)
+            self.stages.append(sink)
+
+        # merge sensor emits within a time window
+        if pars.emit_batch_window > 0:
+            sink = EmitBatcher(sink,
+                               window=pars.emit_batch_window / 1000,
+                               max_entries=pars.emit_batch_size)
+            self.stages.append(sink)
+
+        return sink
+
+    def create_dedup(self):
+        '''create a cache to suppress unchanged sensor values'''
+
+        from laporte_mqtt.dedup import ChangeFilter
+
+        if self.pars.dedup_max_age > 0:
+            return ChangeFilter(self.pars.dedup_max_age, self.pars.dedup_cache_size)
+        return None
+
+    def get_mqtt_options(self):
+        '''mqtt client options of a single process or a worker'''
+
+        from laporte_mqtt.backoff import Backoff
+        from laporte_mqtt.capture import CaptureWriter
+
+        pars = self.pars
+        ret = {
+            'max_inflight': pars.mqtt_max_inflight,
+            'max_queued': pars.mqtt_max_queued,
+            'outbox_size': pars.mqtt_outbox_size,
+            'backoff': Backoff(pars.mqtt_reconnect_delay_min, pars.mqtt_reconnect_delay_max,
+                               pars.mqtt_reconnect_jitter),
+            'clean_session': not pars.mqtt_persistent_session,
+            'subscribe_qos': pars.mqtt_subscribe_qos,
+            'warmup_quiet': pars.mqtt_warmup_quiet,
+            'warmup_max': pars.mqtt_warmup_max,
+        }
+
+        # a persistent session is bound to a client id stable across restarts
+        client_id = pars.mqtt_client_id
+        if not client_id:
+            if pars.mqtt_persistent_session:
+                client_id = f'{app_name}_{socket.gethostname()}'
+            else:
+                client_id = app_instance
+        ret['client_id'] = client_id
+
+        # capture received messages for laporte-mqtt-replay
+        if pars.capture_file:
+            capture_file = pars.capture_file
+            if pars.worker_id >= 0:
+                capture_file = f'{capture_file}.{pars.worker_id}'
+            self.capture = CaptureWriter(capture_file, max_bytes=pars.capture_max_size * 2**20)
+            ret['capture'] = self.capture
+
+        if pars.worker_id >= 0:
+            ret['client_id'] = f'{client_id}_{pars.worker_id}'
+            ret['share_group'] = pars.share_group
+            ret['pinned'] = pars.worker_id == 0
+
+        return ret
+
+    def get_laporte_rooms(self, gateways):
+        '''gateways joined in Laporte, only the first worker receives actuators'''
+
+        if self.pars.worker_id > 0:
+            return []
+        return list(gateways.get_names())
+
+    def create_mqtt(self, laporte, **kwargs):
+        '''create mqtt clients of all brokers'''
+
+        from laporte_mqtt.pool import MqttPool
+
+        pars = self.pars
+        return MqttPool(self.gateways,
+                        laporte, (pars.mqtt_broker_host, pars.mqtt_broker_port),
+                        sink=self.create_sink(laporte),
+                        dedup=self.create_dedup(),
+                        **kwargs,
+                        **self.get_mqtt_options())
+
+    def start_summary(self):
+        '''start periodic summary log lines'''
+
+        from laporte_mqtt.msglog import MessageSummary
+
+        if self.pars.log_summary_interval > 0:
+            self.summary = MessageSummary(self.mqtt.gateway_metrics,
+                                          self.pars.log_summary_interval)
+            self.summary.start()
+
+    def create_reloader(self):
+        '''create a reloader of gateways config used by running clients'''
+
+        from laporte_mqtt.reload import ConfigReloader
+
+        def apply_gateways(gateways):
+            self.gateways = gateways
+            self.mqtt.apply_gateways(gateways)
+            self.laporte.join_gateways(self.get_laporte_rooms(gateways))
+
+        return ConfigReloader(self.pars.config_file, apply_gateways)
+
+    def reload(self, *_) -> None:
+        '''reload the gateways config file (a SIGHUP handler)'''
+
+        if self.reloader is None:
+            return
+        # the threads runtime reloads in the reloader thread, the event loop
+        # runtime in a callback of the loop (running its clients)
+        if self.thread is not None:
+            self.reloader.request()
+        else:
+            self.reloader.reload()
+
+    def start(self) -> None:
+        '''
+        connect clients and start MQTT and Socket.IO loops in threads
+        (raise MqttException if the default broker is unreachable)
+        '''
+
+        from laporte_mqtt.laporte import Laporte
+        from laporte_mqtt.pipeline import ShardedIngestQueue, IngestWorkers
+
+        pars = self.pars
+        gateways = self.load_gateways()
+        self.thread = threading.Thread(target=self.loop)
+
+        # create laporte client
+        self.laporte = Laporte(pars.laporte_host,
+                               pars.laporte_port,
+                               gateways=self.get_laporte_rooms(gateways))
+
+        # queue received messages for worker threads, a queue per thread
+        ingest = None
+        if pars.ingest_workers > 0:
+            ingest = ShardedIngestQueue(pars.ingest_queue_size, pars.ingest_policy,
+                                        pars.ingest_workers)
+
+        self.mqtt = self.create_mqtt(self.laporte, ingest=ingest)
+        self.laporte.mqtt = self.mqtt
+
+        try:
+            self.mqtt.connect(keepalive=pars.mqtt_keepalive)
+        except Exception:
+            self.close()
+            self.laporte.disconnect()
+            raise
+
+        self.start_summary()
+
+        # reload gateways config on a request or a file change
+        self.reloader = self.create_reloader()
+        threading.Thread(target=self.reloader.watch,
+                         args=(pars.config_reload_interval, ),
+                         name='config-reload',
+                         daemon=True).start()
+
+        # start ingest workers
+        if ingest is not None:
+            self.ingest_workers = IngestWorkers(ingest)
+            self.ingest_workers.start()
+
+        # start MQTT loops
+        self.mqtt.start()
+
+        # start Socket.IO loop
+        self.thread.start()
+
+    def loop(self) -> None:
+        '''Socket.IO loop of the threads runtime'''
+
+        self.laporte.loop()
+
+    async def run(self) -> None:
+        '''
+        run MQTT and Socket.IO clients on the running event loop until stop()
+        (raise MqttException if the default broker is unreachable)
+        '''
+
+        # asyncio Socket.IO client needs the optional aiohttp package
+        from laporte_mqtt.aio import AsyncLaporte, AsyncMqqt, watch_config
+
+        pars = self.pars
+        gateways = self.load_gateways()
+
+        # create laporte client
+        self.laporte = AsyncLaporte(gateways=self.get_laporte_rooms(gateways))
+        await self.laporte.connect(pars.laporte_host, pars.laporte_port)
+
+        self.mqtt = self.create_mqtt(self.laporte, client_class=AsyncMqqt)
+        self.laporte.mqtt = self.mqtt
+        self.start_summary()
+
+        # reload gateways config on a file change
+        self.reloader = self.create_reloader()
+        if pars.config_reload_interval > 0:
+            self.watch = self.laporte.loop.create_task(
+                watch_config(self.reloader, pars.config_reload_interval))
+
+        try:
+            await self.mqtt.run(keepalive=pars.mqtt_keepalive)
+        finally:
+            self.close()
+            await self.laporte.disconnect()
+
+    def close(self) -> None:
+        '''finish threads of the emit stages and helpers, flush their buffers'''
+
+        if self.reloader is not None:
+            self.reloader.stop()
+        if self.watch is not None:
+            self.watch.cancel()
+        if self.summary is not None:
+            self.summary.stop()
+        # queued messages are processed before the emit stages finish
+        if self.ingest_workers is not None:
+            self.ingest_workers.stop()
+        # outer stages first, so their buffers are emitted through the inner ones
+        for stage in reversed(self.stages):
+            stage.stop()
+        if self.capture is not None:
+            self.capture.stop()
+
+    def stop(self) -> None:
+        '''disconnect clients and finish the emit stages, their loops finish then'''
+
+        if self.mqtt is not None:
+            self.mqtt.stop()
+        # the event loop runtime closes stages and disconnects Laporte as run() finishes
+        if self.thread is not None and self.laporte is not None:
+            self.close()
+            self.laporte.disconnect()
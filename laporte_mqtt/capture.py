@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+'''
+Binary log of received MQTT messages to replay them offline
+'''
+
+import struct
+import logging
+import threading
+from time import time
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+CAPTURE_MAGIC = b'LPMQCAP1'
+# timestamp, retain flag, topic length, payload length
+RECORD_HEADER = struct.Struct('<dBHI')
+FLUSH_INTERVAL = 1.0
+
+
+class CaptureWriter():
+    '''
+    Append (timestamp, topic, payload, retain) records of received
+    messages to a capture file, buffered and flushed every FLUSH_INTERVAL.
+    Capturing stops when the file reaches max_bytes.
+    '''
+    def __init__(self, filename: str, max_bytes: int = 100 * 2**20) -> None:
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.stream = open(filename, 'wb')  # pylint: disable=consider-using-with
+        self.stream.write(CAPTURE_MAGIC)
+        self.size = len(CAPTURE_MAGIC)
+        self.records = 0
+        logging.info("capturing MQTT messages to %s", filename)
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def write(self, msg) -> None:
+        '''append a received paho message'''
+
+        topic = msg.topic.encode('utf8')
+        record = RECORD_HEADER.pack(time(), int(msg.retain), len(topic),
+                                    len(msg.payload)) + topic + msg.payload
+
+        with self.lock:
+            if self.stream is None:
+                return
+            if self.size + len(record) > self.max_bytes:
+                logging.error("capture: size limit reached after %s messages, stopped",
+                              self.records)
+                self.close()
+                return
+            self.stream.write(record)
+            self.size += len(record)
+            self.records += 1
+
+    def close(self) -> None:
+        '''finish the capture file (call with the lock held)'''
+
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def stop(self) -> None:
+        '''finish the loop and the capture file'''
+
+        self.stopped.set()
+        self.thread.join()
+        with self.lock:
+            self.close()
+
+    def loop(self):
+        '''flush buffered records periodically until stop()'''
+
+        while not self.stopped.wait(FLUSH_INTERVAL):
+            with self.lock:
+                if self.stream is None:
+                    return
+                self.stream.flush()
+
+
+def read_capture(filename: str):
+    '''yield (timestamp, topic, payload, retain) records of a capture file'''
+
+    with open(filename, 'rb') as stream:
+        data = stream.read()
+
+    if not data.startswith(CAPTURE_MAGIC):
+        raise ValueError(f"{filename} is not a laporte-mqtt capture file")
+
+    pos = len(CAPTURE_MAGIC)
+    while pos + RECORD_HEADER.size <= len(data):
+        timestamp, retain, topic_len, payload_len = RECORD_HEADER.unpack_from(data, pos)
+        pos += RECORD_HEADER.size
+        if pos + topic_len + payload_len > len(data):
+            logging.error("capture: truncated record in %s", filename)
+            return
+        topic = data[pos:pos + topic_len].decode('utf8')
+        pos += topic_len
+        yield timestamp, topic, data[pos:pos + payload_len], bool(retain)
+        pos += payload_len
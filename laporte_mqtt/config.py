@@ -4,40 +4,100 @@ Objects that collect mqtt prefixes setup for sensors
 '''
 
 # pylint: disable=too-few-public-methods
+import re
 import sys
+import copy
 import logging
-from yaml import safe_load, YAMLError
+from laporte_mqtt.throttle import ThrottleConfig
+from laporte_mqtt.transform import TransformPlan
+from laporte_mqtt.schemas import get_codec
 
 SCHEMA_JSON = 0
 SCHEMA_VALUE = 1
+SCHEMA_MSGPACK = 2
+SCHEMA_CBOR = 3
+SCHEMA_INFLUX = 4
+SCHEMAS = {
+    "json": SCHEMA_JSON,
+    'value': SCHEMA_VALUE,
+    'msgpack': SCHEMA_MSGPACK,
+    'cbor': SCHEMA_CBOR,
+    'influx': SCHEMA_INFLUX
+}
+SCHEMA_NAMES = {schema: name for name, schema in SCHEMAS.items()}
 
 # create logger
 logging.getLogger(__name__).addHandler(logging.NullHandler())
 
 
+class ConfigError(Exception):
+    '''invalid gateways config'''
+
+
 class GatewayConfig():
     '''mqtt setup of one gateway'''
+
+    __slots__ = ('name', 'broker', 'subscribe_topic', 'subscribe_schema', 'subscribe_pattern',
+                 'subscribe_shared', 'subscribe_throttle', 'subscribe_transform',
+                 'subscribe_priority', 'subscribe_final', 'publish_schema', 'publish_pattern',
+                 'publish_qos', 'publish_retain', 'format_publish_topic', 'subscribe_codec',
+                 'publish_codec')
+
     def __init__(self,
                  name,
+                 broker=None,
                  subscribe_topic='#',
                  subscribe_schema=SCHEMA_JSON,
-                 subscribe_pattern='.*/(.*)',
+                 subscribe_pattern=None,
+                 subscribe_shared=True,
+                 subscribe_throttle=None,
+                 subscribe_transform=None,
+                 subscribe_priority=0,
+                 subscribe_final=False,
                  publish_schema=SCHEMA_JSON,
-                 publish_pattern=''):
+                 publish_pattern='',
+                 publish_qos=0,
+                 publish_retain=False):
 
         self.name = name
+        self.broker = broker
         self.subscribe_topic = subscribe_topic
         self.subscribe_schema = subscribe_schema
-        self.subscribe_pattern = subscribe_pattern
+        self.subscribe_shared = subscribe_shared
+        self.subscribe_throttle = subscribe_throttle
+        self.subscribe_transform = subscribe_transform
+        # precedence of gateways matching one topic
+        self.subscribe_priority = subscribe_priority
+        self.subscribe_final = subscribe_final
         self.publish_schema = publish_schema
         self.publish_pattern = publish_pattern
+        self.publish_qos = publish_qos
+        self.publish_retain = publish_retain
+        # pre-bound topic builder of actuator publishes
+        self.format_publish_topic = publish_pattern.format
+        # payload decoder/encoder (raise ImportError if its package is missing)
+        self.subscribe_codec = get_codec(SCHEMA_NAMES[subscribe_schema])
+        self.publish_codec = get_codec(SCHEMA_NAMES[publish_schema])
+        # default pattern fitting the subscribe schema
+        if subscribe_pattern is None:
+            subscribe_pattern = self.subscribe_codec.pattern
+        self.subscribe_pattern = subscribe_pattern
 
 
 class GatewaysConfig():
     '''container to store mqtt setup from config file'''
+
+    __slots__ = ('filename', 'gateway_list', 'gateway_map')
+
     @staticmethod
-    def load_config(filename):
-        '''read config file and parse yaml to config_dict'''
+    def load_config(filename, exit_on_error=True):
+        '''
+        read config file and parse yaml to config_dict
+        (exit on error or raise it if exit_on_error is False)
+        '''
+
+        # pylint: disable=import-outside-toplevel
+        from yaml import safe_load, YAMLError
 
         ret = []
 
@@ -47,13 +107,45 @@ class GatewaysConfig():
                     config_dict = safe_load(stream)
                 except YAMLError as exc:
                     logging.error(exc)
-                    sys.exit(1)
+                    if exit_on_error:
+                        sys.exit(1)
+                    raise
         except FileNotFoundError as exc:
             logging.critical(exc)
-            sys.exit(1)
+            if exit_on_error:
+                sys.exit(1)
+            raise
+
+        if not isinstance(config_dict, dict):
+            logging.critical("%s: gateways config is not a mapping", filename)
+            if exit_on_error:
+                sys.exit(1)
+            raise ConfigError(f"{filename}: gateways config is not a mapping")
 
         for gateway_name, gateway_setup in config_dict.items():
-            params = {"name": gateway_name}
+            try:
+                gw_item = GatewaysConfig.parse_gateway(gateway_name, gateway_setup)
+            except (ConfigError, ImportError) as exc:
+                logging.critical("gateway %s: %s", gateway_name, exc)
+                if exit_on_error:
+                    sys.exit(1)
+                raise
+            ret.append(gw_item)
+
+        return ret
+
+    @staticmethod
+    def parse_gateway(gateway_name, gateway_setup):
+        '''
+        return a gateway config of its yaml setup
+        (raise ConfigError if invalid, ImportError if a codec package is missing)
+        '''
+
+        params = {"name": gateway_name}
+
+        try:
+            if 'broker' in gateway_setup:
+                params['broker'] = str(gateway_setup['broker'])
 
             for direction in ['subscribe', 'publish']:
                 if direction in gateway_setup:
@@ -61,25 +153,55 @@ class GatewaysConfig():
                         params[direction + "_topic"] = gateway_setup[direction]['topic']
 
                     if 'schema' in gateway_setup[direction]:
-                        schemas_map = {"json": SCHEMA_JSON, 'value': SCHEMA_VALUE}
                         schema_str = gateway_setup[direction]['schema']
-                        try:
-                            schema = schemas_map[schema_str]
-                        except KeyError:
-                            logging.error("unknown schema %s", schema_str)
-
-                        params[direction + '_schema'] = schema
+                        if schema_str not in SCHEMAS:
+                            raise ConfigError(f"unknown {direction} schema {schema_str}")
+                        params[direction + '_schema'] = SCHEMAS[schema_str]
                     if 'pattern' in gateway_setup[direction]:
                         params[direction +
                                '_pattern'] = gateway_setup[direction]['pattern']
 
-            gw_item = GatewayConfig(**params)
-            ret.append(gw_item)
+            if 'shared' in gateway_setup.get('subscribe', {}):
+                params['subscribe_shared'] = bool(gateway_setup['subscribe']['shared'])
+            if 'throttle' in gateway_setup.get('subscribe', {}):
+                throttle = gateway_setup['subscribe']['throttle']
+                params['subscribe_throttle'] = ThrottleConfig(throttle.get('window', 1),
+                                                              throttle.get('reduce'))
+            subscribe = gateway_setup.get('subscribe', {})
+            if 'keys' in subscribe or 'transform' in subscribe:
+                params['subscribe_transform'] = TransformPlan(gateway_name,
+                                                              subscribe.get('keys'),
+                                                              subscribe.get('transform'))
+            if 'priority' in subscribe:
+                params['subscribe_priority'] = int(subscribe['priority'])
+            if 'final' in subscribe:
+                params['subscribe_final'] = bool(subscribe['final'])
+            if 'qos' in gateway_setup.get('publish', {}):
+                params['publish_qos'] = int(gateway_setup['publish']['qos'])
+            if 'retain' in gateway_setup.get('publish', {}):
+                params['publish_retain'] = bool(gateway_setup['publish']['retain'])
+        except (AttributeError, KeyError, TypeError, ValueError) as exc:
+            raise ConfigError(f"invalid setup: {exc}") from exc
+
+        gateway = GatewayConfig(**params)
+
+        # number of pattern groups expected by a subscribe schema
+        pattern = gateway.subscribe_pattern
+        try:
+            groups = re.compile(pattern.format("(.*)", "(.*)")).groups
+        except (AttributeError, IndexError, KeyError, ValueError, re.error) as exc:
+            raise ConfigError(f"invalid subscribe pattern {pattern}: {exc}") from exc
+        if groups != gateway.subscribe_codec.groups:
+            raise ConfigError(f"subscribe pattern {pattern} does not fit schema "
+                              f"{SCHEMA_NAMES[gateway.subscribe_schema]} "
+                              f"({gateway.subscribe_codec.groups} groups expected)")
 
-        return ret
+        return gateway
 
-    def __init__(self, filename):
-        self.gateway_list = self.load_config(filename)
+    def __init__(self, filename, exit_on_error=True):
+        self.filename = filename
+        self.gateway_list = self.load_config(filename, exit_on_error)
+        self.gateway_map = {gateway.name: gateway for gateway in self.gateway_list}
 
     def get(self):
         '''generate gateways used in a for loop'''
@@ -93,10 +215,20 @@ class GatewaysConfig():
         for gateway in self.gateway_list:
             yield gateway.name
 
+    def subset(self, gateway_names):
+        '''return a config container with given gateways only'''
+
+        ret = copy.copy(self)
+        ret.gateway_list = [
+            gateway for gateway in self.gateway_list if gateway.name in gateway_names
+        ]
+        ret.gateway_map = {gateway.name: gateway for gateway in ret.gateway_list}
+        return ret
+
     def find_gateway(self, gateway_name):
         '''return a gateway with given name'''
 
-        for gateway in self.gateway_list:
-            if gateway.name == gateway_name:
-                return gateway
-        raise KeyError
+        try:
+            return self.gateway_map[gateway_name]
+        except KeyError as exc:
+            raise KeyError(f"unknown gateway {gateway_name}") from exc
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+'''
+Change-detection cache suppressing duplicate sensor values
+'''
+
+import logging
+import threading
+from collections import OrderedDict
+from time import monotonic
+from laporte_mqtt.nodes import node_registry, intern
+from laporte_mqtt.metrics import (dedup_hits_total, dedup_suppressed_total,
+                                  dedup_evictions_total)
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+class ChangeFilter():
+    '''
+    Last-value cache per (node, key), an unchanged value
+    is forwarded at most once per max_age seconds (heartbeat).
+    The least recently updated entries are evicted above max_entries.
+    '''
+    def __init__(self, max_age=60, max_entries=100000):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def changed(self, item, value, now):
+        '''check and update a cached value (call with the lock held)'''
+
+        cached = self.cache.get(item)
+        if cached is not None:
+            dedup_hits_total.inc()
+            last_value, last_time = cached
+            if last_value == value and now - last_time < self.max_age:
+                dedup_suppressed_total.inc()
+                return False
+            self.cache.move_to_end(item)
+
+        self.cache[item] = (value, now)
+        if len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+            dedup_evictions_total.inc()
+
+        return True
+
+    def filter(self, gateway_name, message):
+        '''return a {node: {key: value}} message without unchanged values'''
+
+        ret = {}
+        now = monotonic()
+
+        with self.lock:
+            for node_addr, value in message.items():
+                node = node_registry.node(gateway_name, node_addr)
+                if isinstance(value, dict):
+                    keys = {
+                        key: key_value
+                        for key, key_value in value.items()
+                        if self.changed((node, intern(key)), key_value, now)
+                    }
+                    if keys:
+                        ret[node_addr] = keys
+                elif self.changed((node, None), value, now):
+                    ret[node_addr] = value
+
+        return ret
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+'''
+Acknowledged, windowed flow control of emits to Laporte
+'''
+
+import logging
+import threading
+from time import monotonic
+from laporte_mqtt.batcher import merge_nodes
+from laporte_mqtt.policies import FLOW_POLICIES, POLICY_COALESCE
+from laporte_mqtt.metrics import (emit_ack_rtt, emit_window_inflight, emit_window_full_total,
+                                  emit_ack_timeouts_total)
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+class AckWindow():
+    '''
+    Emit stage asking the target (Laporte) for Socket.IO acknowledgements,
+    at most window emits wait for one. With the window full, the block
+    policy makes the emitting thread wait (backpressure up to the MQTT
+    client), the coalesce policy merges emits into pending {node: values}
+    sent as acknowledgements free the window. An emit not acknowledged
+    within timeout seconds leaves the window.
+    '''
+    def __init__(self,
+                 target,
+                 window: int = 10,
+                 policy: str = POLICY_COALESCE,
+                 timeout: float = 10.0) -> None:
+        if policy not in FLOW_POLICIES:
+            raise ValueError(f"unknown flow control policy {policy}")
+
+        self.target = target
+        self.window = window
+        self.policy = policy
+        self.timeout = timeout
+        self.inflight = {}
+        self.seq = 0
+        self.pending = {}
+        self.pending_stamps = {}
+        self.running = True
+        self.cond = threading.Condition()
+        # slots are taken and emits sent under one lock, so they go out in order
+        # (reentrant for an acknowledgement called back within an emit)
+        self.send_lock = threading.RLock()
+        emit_window_inflight.add(self.__len__)
+
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.inflight)
+
+    def is_connected(self) -> bool:
+        return self.target.is_connected()
+
+    def acquire(self) -> int:
+        '''take a slot of the window (call with the lock held)'''
+
+        self.seq += 1
+        self.inflight[self.seq] = monotonic()
+        return self.seq
+
+    def expire(self, now) -> None:
+        '''free slots of emits not acknowledged in time (call with the lock held)'''
+
+        while self.inflight:
+            seq, sent = next(iter(self.inflight.items()))
+            if now - sent < self.timeout:
+                return
+            del self.inflight[seq]
+            emit_ack_timeouts_total.inc()
+            logging.warning("Laporte emit not acknowledged in %s s", self.timeout)
+
+    def take_pending(self, overflow=False) -> list:
+        '''
+        return pending emits fitting into free slots (all of them with overflow)
+        (call with the lock held)
+        '''
+
+        ret = []
+        while self.pending and (overflow or len(self.inflight) < self.window):
+            response = next(iter(self.pending))
+            ret.append((self.acquire(), response, self.pending.pop(response),
+                        self.pending_stamps.pop(response, None)))
+        return ret
+
+    def emit(self, response, message, stamps=None):
+        '''emit to the target or coalesce/wait with the window full'''
+
+        if self.policy == POLICY_COALESCE:
+            with self.send_lock:
+                with self.cond:
+                    self.expire(monotonic())
+                    full = len(self.inflight) >= self.window
+                    if full:
+                        emit_window_full_total.inc()
+                    # pending emits go first, so newer values are never overwritten
+                    if full or self.pending:
+                        merge_nodes(self.pending.setdefault(response, {}), message)
+                        if stamps:
+                            self.pending_stamps.setdefault(response, []).extend(stamps)
+                        batch = self.take_pending()
+                    else:
+                        batch = None
+                        seq = self.acquire()
+
+                if batch is None:
+                    self.send(seq, response, message, stamps)
+                else:
+                    self.send_batch(batch)
+            return
+
+        with self.cond:
+            self.expire(monotonic())
+            if len(self.inflight) >= self.window:
+                emit_window_full_total.inc()
+            while len(self.inflight) >= self.window:
+                self.cond.wait(self.timeout)
+                self.expire(monotonic())
+            seq = self.acquire()
+
+        self.send(seq, response, message, stamps)
+
+    def send(self, seq, response, message, stamps=None):
+        '''emit with an acknowledgement callback'''
+
+        def callback(*args):
+            del args  # Ignored parameters
+            self.acked(seq)
+
+        try:
+            self.target.emit(response, message, callback=callback, stamps=stamps)
+        except Exception:
+            with self.cond:
+                self.inflight.pop(seq, None)
+                self.cond.notify_all()
+            raise
+
+    def acked(self, seq):
+        '''free the slot of an acknowledged emit, send pending emits'''
+
+        with self.cond:
+            sent = self.inflight.pop(seq, None)
+            if sent is None:  # already expired
+                return
+            emit_ack_rtt.observe(monotonic() - sent)
+            pending = bool(self.pending)
+            self.cond.notify_all()
+
+        if pending:
+            self.send_pending()
+
+    def send_pending(self):
+        '''send pending emits fitting into free slots'''
+
+        with self.send_lock:
+            with self.cond:
+                batch = self.take_pending()
+            self.send_batch(batch)
+
+    def send_batch(self, batch):
+        for seq, response, message, stamps in batch:
+            try:
+                self.send(seq, response, message, stamps)
+            except Exception as exc:  # pylint: disable=broad-except
+                logging.error("Laporte emit failed: %s", exc)
+
+    def stop(self):
+        '''finish the loop and send pending emits regardless of the window'''
+
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
+
+        with self.send_lock:
+            with self.cond:
+                batch = self.take_pending(overflow=True)
+            self.send_batch(batch)
+        emit_window_inflight.remove(self.__len__)
+
+    def loop(self):
+        '''expire unacknowledged emits and send pending emits meanwhile until stop()'''
+
+        while True:
+            with self.cond:
+                if not self.running:
+                    return
+                now = monotonic()
+                self.expire(now)
+                if not self.pending or len(self.inflight) >= self.window:
+                    timeout = self.timeout
+                    if self.inflight:
+                        timeout = next(iter(self.inflight.values())) + self.timeout - now
+                    self.cond.wait(max(timeout, 0.01))
+                    continue
+
+            self.send_pending()
@@ -4,9 +4,13 @@ Connect to Laporte Socket.IO
 '''
 
 import logging
-import json
+from time import perf_counter
 from laporte.client import LaporteClient
-from laporte_mqtt.config import SCHEMA_JSON, SCHEMA_VALUE
+from laporte.client.sio import METRICS_NAMESPACE
+from laporte.client.metrics import laporte_emits_total
+from laporte_mqtt.metrics import (actuator_publishes_total, actuator_publish_time,
+                                  observe_stamps)
+from laporte_mqtt.msglog import message_log
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
 
@@ -18,24 +22,64 @@ class Laporte(LaporteClient):
     def publish_actuator(self, gateway, node_addr, keys):
         '''function launched upon an actuator response'''
 
-        logging.info("Laporte receive: {'%s': %s}", node_addr, keys)
+        start = perf_counter()
+        message_log.info(node_addr, "Laporte receive: {'%s': %s}", node_addr, keys)
         if self.mqtt is None:
             logging.error("mqtt client not set")
             return
 
-        gateway = self.mqtt.gateways.find_gateway(gateway)
+        try:
+            gateway = self.mqtt.gateways.find_gateway(gateway)
+            client = self.mqtt.get_client(gateway)
+        except KeyError as exc:
+            logging.error("Laporte actuator ignored: %s", exc)
+            return
+
+        # all keys are handed to paho without waiting for acknowledges,
+        # QoS>0 publishes are then limited by the max inflight messages
+        publish = client.publish
+        qos = gateway.publish_qos
+        retain = gateway.publish_retain
+        messages = gateway.publish_codec.encode(node_addr, keys)
+
+        for topic_args, payload in messages:
+            info = publish(gateway.format_publish_topic(*topic_args), payload, qos, retain)
+            client.trace_publish(info, gateway.name, start)
+
+        actuator_publishes_total.labels(gateway.name).inc(len(messages))
+        actuator_publish_time.labels(gateway.name).observe(perf_counter() - start)
+
+    def emit(self, response, message, namespace=METRICS_NAMESPACE, callback=None, stamps=None):
+        '''
+        emit custom response to the Laporte (callback called upon its acknowledgement),
+        observe latencies of stamps of MQTT messages emitted
+        '''
+
+        message_log.info(response, "Laporte emit: %s %s", response, message)
+        laporte_emits_total.labels(response, namespace).inc()
+        self.sio.emit(response, message, namespace=namespace, callback=callback)
+        observe_stamps(stamps)
 
-        if gateway.subscribe_schema == SCHEMA_JSON:
-            topic = gateway.publish_pattern.format(node_addr)
-            payload = json.dumps(keys)
-            logging.info("MQTT publish: %s %s", topic, payload)
-            self.mqtt.publish(topic, payload)
+    def is_connected(self) -> bool:
+        '''check the metrics namespace is connected'''
 
-        elif gateway.subscribe_schema == SCHEMA_VALUE:
-            for key, value in keys.items():
-                topic = gateway.publish_pattern.format(node_addr, key)
-                logging.info("MQTT publish: %s %s", topic, value)
-                self.mqtt.publish(topic, value)
+        return self.sio.connected and METRICS_NAMESPACE in self.sio.namespaces
+
+    def disconnect(self) -> None:
+        '''disconnect from the Laporte server, loop() returns then'''
+
+        self.sio.disconnect()
+
+    def join_gateways(self, gateways: list) -> None:
+        '''join Laporte rooms of gateways added by a config reload'''
+
+        joined = self.ns_metrics.gateways
+        self.ns_metrics.gateways = gateways
+        if not self.sio.connected:
+            return
+        for gw_name in gateways:
+            if gw_name not in joined:
+                self.ns_metrics.emit("join", {'room': gw_name})
 
     def __init__(self, addr: str, port: int, gateways: list = None) -> None:
         self.mqtt = None
@@ -3,15 +3,28 @@
 Configured logger (light version)
 '''
 
+import atexit
 import logging
-from laporte_mqtt.argparser import pars
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+LOG_FORMAT = '%(levelname)s %(module)s %(funcName)s: %(message)s'
+
+
+class AsyncQueueHandler(QueueHandler):
+    '''
+    queue handler passing records as they are,
+    so the message is formatted in the listener thread
+    '''
+    def prepare(self, record):
+        return record
 
 
 class ConfLogger():
     '''
     set a logger with configured handlers and filters
     '''
-    def __init__(self, name, log_level=logging.DEBUG, log_verbose=False):
+    def __init__(self, name, log_level=logging.DEBUG, log_verbose=False, log_async=False):
         '''
         set logger
         '''
@@ -23,10 +36,16 @@ class ConfLogger():
             logging.StreamHandler(),
         ]
 
-        logging.basicConfig(format='%(levelname)s %(module)s %(funcName)s:'
-                            ' %(message)s',
-                            level=log_level,
-                            handlers=handlers)
+        # write log records in a background thread
+        if log_async:
+            queue = SimpleQueue()
+            handlers[0].setFormatter(logging.Formatter(LOG_FORMAT))
+            listener = QueueListener(queue, *handlers)
+            listener.start()
+            atexit.register(listener.stop)
+            handlers = [AsyncQueueHandler(queue)]
+
+        logging.basicConfig(format=LOG_FORMAT, level=log_level, handlers=handlers)
 
         if not log_verbose:
             for module in ['socketio', 'engineio']:
@@ -37,6 +56,3 @@ class ConfLogger():
     def get_logger(self):
         return self.logger
 
-
-cl = ConfLogger(__name__, log_level=pars.log_level, log_verbose=pars.log_verbose)
-logger = cl.get_logger()
@@ -3,52 +3,100 @@
 MQTT bridge for Laporte
 '''
 
-import threading
-from prometheus_client import start_http_server
-from laporte_mqtt.logger import logger
-from laporte_mqtt.argparser import pars
+import signal
+import logging
+from laporte_mqtt.logger import ConfLogger
+from laporte_mqtt.argparser import get_pars, ENGINE_ASYNCIO
 from laporte_mqtt.version import app_instance
-from laporte_mqtt.config import GatewaysConfig
-from laporte_mqtt.mqtt import Mqqt, MqttException
-from laporte_mqtt.laporte import Laporte
 
+# pylint: disable=import-outside-toplevel
+# client modules are imported after cmd line options are parsed,
+# so --help and --version do not wait for them
 
-def main():
-    '''
-    start main loops
-    '''
 
-    logger.info("Start %s...", app_instance)
+def start_exporter(pars):
+    '''start up the server to expose prometheus metrics'''
 
-    # create cofiguration data container
-    gateways = GatewaysConfig(pars.config_file)
+    from prometheus_client import start_http_server
+    from laporte_mqtt import profiler
 
-    # create laporte client
-    laporte = Laporte(pars.laporte_host,
-                      pars.laporte_port,
-                      gateways=list(gateways.get_names()))
+    # metrics of workers are exposed by the supervisor
+    if pars.worker_id < 0:
+        if pars.profile_endpoint:
+            profiler.start_http_server(pars.listen_port, addr=pars.listen_addr)
+        else:
+            start_http_server(pars.listen_port, addr=pars.listen_addr)
+
+
+def main_threads(bridge):
+    '''
+    start MQTT and Socket.IO loops in threads
+    '''
 
-    # create mqtt client
-    mqtt = Mqqt(gateways, laporte)
-    laporte.mqtt = mqtt
+    from laporte_mqtt.mqtt import MqttException
 
     try:
-        mqtt.connect(
-            pars.mqtt_broker_host,
-            pars.mqtt_broker_port,
-            keepalive=pars.mqtt_keepalive,
-        )
+        bridge.start()
     except MqttException as exc:
-        logger.critical(exc)
+        logging.critical(exc)
         return
 
     # start up the server to expose promnetheus metrics.
-    start_http_server(pars.listen_port, addr=pars.listen_addr)
+    start_exporter(bridge.pars)
+
+    # reload gateways config on SIGHUP
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, bridge.reload)
+
+
+async def main_asyncio(bridge):
+    '''
+    run MQTT and Socket.IO clients on one event loop
+    '''
+
+    import asyncio
+    from laporte_mqtt.mqtt import MqttException
+
+    # start up the server to expose promnetheus metrics.
+    start_exporter(bridge.pars)
+
+    # reload gateways config on SIGHUP
+    loop = asyncio.get_running_loop()
+    if hasattr(signal, 'SIGHUP'):
+        loop.add_signal_handler(signal.SIGHUP, bridge.reload)
+
+    try:
+        await bridge.run()
+    except MqttException as exc:
+        logging.critical(exc)
+
+
+def main():
+    '''
+    start main loops
+    '''
+
+    pars = get_pars()
+    logger = ConfLogger(__name__,
+                        log_level=pars.log_level,
+                        log_verbose=pars.log_verbose,
+                        log_async=pars.log_async).get_logger()
+
+    from laporte_mqtt.msglog import message_log
+
+    logger.info("Start %s...", app_instance)
+    message_log.rate = pars.log_topic_rate
+
+    if pars.workers > 0:
+        from laporte_mqtt.workers import Supervisor
+        Supervisor(pars.workers).run(pars.listen_addr, pars.listen_port)
+        return
 
-    # start MQTT loop
-    thread1 = threading.Thread(target=mqtt.loop)
-    thread1.start()
+    from laporte_mqtt.bridge import Bridge
+    bridge = Bridge(pars)
 
-    # start Socket.IO loop
-    thread2 = threading.Thread(target=laporte.loop)
-    thread2.start()
+    if pars.engine == ENGINE_ASYNCIO:
+        import asyncio
+        asyncio.run(main_asyncio(bridge))
+    else:
+        main_threads(bridge)
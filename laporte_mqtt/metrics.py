@@ -3,7 +3,103 @@
 Prometheus metrics to monitor requests.
 '''
 
-from prometheus_client import Summary, Counter
+import os
+import threading
+from time import monotonic, sleep
+from weakref import WeakMethod
+from prometheus_client import Summary, Counter, Gauge, Histogram
+
+# function gauges are not written to files of worker processes,
+# values of GaugeSources are set periodically there
+MULTIPROCESS = 'PROMETHEUS_MULTIPROC_DIR' in os.environ
+GAUGE_UPDATE_INTERVAL = 1.0
+
+gauge_sources = []
+gauge_updates = threading.Lock()
+
+
+class GaugeSources():
+    '''
+    Gauge showing values of all objects measuring it (bound methods added
+    as sources) combined, e.g. summed over MQTT clients of a pool or over
+    bridges of a process. Sources are kept per label values and live as
+    long as their objects, a labelled child without sources is removed.
+    In worker processes the gauge is set every GAUGE_UPDATE_INTERVAL.
+    '''
+    def __init__(self, gauge, combine=sum, empty=0):
+        self.gauge = gauge
+        self.combine = combine
+        self.empty = empty
+        self.sources = {}
+        self.lock = threading.Lock()
+        gauge_sources.append(self)
+
+    def add(self, source, *labels):
+        '''add a bound method returning a value of the gauge (its labelled child)'''
+
+        with self.lock:
+            if labels not in self.sources:
+                self.sources[labels] = []
+                if not MULTIPROCESS:
+                    child = self.gauge.labels(*labels) if labels else self.gauge
+                    child.set_function(lambda: self.value(labels))
+            self.sources[labels].append(WeakMethod(source))
+
+        if MULTIPROCESS:
+            start_gauge_updates()
+
+    def remove(self, source, *labels):
+        '''remove a source (an object not measured anymore)'''
+
+        with self.lock:
+            refs = [ref for ref in self.sources.get(labels, []) if ref() != source]
+            self._set_refs(labels, refs)
+
+    def _set_refs(self, labels, refs):
+        '''keep live sources of label values (call with the lock held)'''
+
+        if refs or not labels:
+            self.sources[labels] = refs
+        elif labels in self.sources:
+            del self.sources[labels]
+            self.gauge.remove(*labels)
+
+    def value(self, labels=()):
+        '''return combined values of live sources'''
+
+        with self.lock:
+            refs = self.sources.get(labels, [])
+            sources = [ref() for ref in refs]
+            if None in sources:
+                self._set_refs(labels, [ref for ref, source in zip(refs, sources) if source])
+        values = [source() for source in sources if source is not None]
+        return self.combine(values) if values else self.empty
+
+    def update(self):
+        '''set the gauge (its labelled children) to combined values'''
+
+        for labels in list(self.sources):
+            value = self.value(labels)
+            if labels in self.sources:
+                child = self.gauge.labels(*labels) if labels else self.gauge
+                child.set(value)
+
+
+def update_gauges():
+    '''set values of GaugeSources periodically forever'''
+
+    while True:
+        sleep(GAUGE_UPDATE_INTERVAL)
+        for sources in gauge_sources:
+            sources.update()
+
+
+def start_gauge_updates():
+    '''start a thread setting values of GaugeSources (once)'''
+
+    if gauge_updates.acquire(blocking=False):
+        threading.Thread(target=update_gauges, name='gauge-updates', daemon=True).start()
+
 
 mqtt_message_time = Summary('mqtt_message_duration_seconds',
                             'Time spent processing MQTT message', [])
@@ -12,3 +108,195 @@ mqtt_emits_total = Counter('mqtt_emits_total', 'Total count of MQTT emits', [])
 
 mqtt_connects_total = Counter('mqtt_client_connects_total',
                               'Total count of connects/reconnects', [])
+
+mqtt_reconnect_attempts_total = Counter('mqtt_client_reconnect_attempts_total',
+                                        'Total count of MQTT reconnect attempts', [])
+
+mqtt_recover_time = Histogram('mqtt_client_recover_duration_seconds',
+                              'Time from a MQTT disconnect to the next successful connect',
+                              buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+
+emit_batch_entries = Histogram('mqtt_emit_batch_entries',
+                               'Count of MQTT messages merged into one Laporte emit', [],
+                               buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+
+emit_window_inflight = GaugeSources(
+    Gauge('mqtt_emit_window_inflight',
+          'Count of Laporte emits waiting for an acknowledgement',
+          multiprocess_mode='livesum'))
+
+emit_window_full_total = Counter('mqtt_emit_window_full_total',
+                                 'Total count of Laporte emits finding the ack window full',
+                                 [])
+
+emit_ack_timeouts_total = Counter('mqtt_emit_ack_timeouts_total',
+                                  'Total count of Laporte emits not acknowledged in time', [])
+
+ingest_queue_depth = GaugeSources(
+    Gauge('mqtt_ingest_queue_depth',
+          'Count of received MQTT messages waiting for processing',
+          multiprocess_mode='livesum'))
+
+ingest_dropped_total = Counter('mqtt_ingest_dropped_total',
+                               'Total count of MQTT messages dropped by a full ingest queue',
+                               [])
+
+ingest_coalesced_total = Counter('mqtt_ingest_coalesced_total',
+                                 'Total count of queued MQTT messages replaced by a newer one',
+                                 [])
+
+dedup_hits_total = Counter('mqtt_dedup_cache_hits_total',
+                           'Total count of sensor values found in the change cache', [])
+
+dedup_suppressed_total = Counter('mqtt_dedup_suppressed_total',
+                                 'Total count of unchanged sensor values not forwarded', [])
+
+dedup_evictions_total = Counter('mqtt_dedup_evictions_total',
+                                'Total count of values evicted from the change cache', [])
+
+spool_size_bytes = GaugeSources(
+    Gauge('mqtt_spool_size_bytes',
+          'Size of sensor data spooled while Laporte is unreachable',
+          multiprocess_mode='livesum'))
+
+spool_records_total = Counter('mqtt_spool_records_total',
+                              'Total count of emits captured to the spool', [])
+
+spool_replayed_total = Counter('mqtt_spool_replayed_total',
+                               'Total count of emits replayed from the spool', [])
+
+spool_dropped_total = Counter('mqtt_spool_dropped_bytes_total',
+                              'Total size of spooled data dropped by the size limit', [])
+
+outbox_depth = GaugeSources(
+    Gauge('mqtt_outbox_depth',
+          'Count of actuator publishes queued while MQTT is disconnected',
+          multiprocess_mode='livesum'))
+
+outbox_dropped_total = Counter('mqtt_outbox_dropped_total',
+                               'Total count of queued actuator publishes dropped',
+                               ['reason'])
+
+throttle_nodes = GaugeSources(
+    Gauge('mqtt_throttle_nodes',
+          'Count of nodes with an open throttle window',
+          multiprocess_mode='livesum'))
+
+throttle_aggregated_total = Counter('mqtt_throttle_aggregated_total',
+                                    'Total count of node samples reduced by a throttle window',
+                                    [])
+
+# complete when all clients (of all workers) are
+warmup_complete = GaugeSources(Gauge('mqtt_warmup_complete',
+                                     'Retained messages replayed after a subscribe are '
+                                     'processed (1/0)',
+                                     multiprocess_mode='livemin'),
+                               combine=min,
+                               empty=1)
+
+warmup_duration = Gauge('mqtt_warmup_duration_seconds',
+                        'Duration of the last retained messages warmup',
+                        multiprocess_mode='livemax')
+
+warmup_retained_total = Counter('mqtt_warmup_retained_total',
+                                'Total count of retained messages collected into snapshots',
+                                [])
+
+STAGE_BUCKETS = (.00001, .000025, .00005, .0001, .00025, .0005, .001, .0025, .005, .01,
+                 .025, .05, .1, .25, .5, 1.0)
+
+stage_duration = Histogram('mqtt_stage_duration_seconds',
+                           'Time spent in a stage of MQTT message processing',
+                           ['stage', 'gateway', 'schema'],
+                           buckets=STAGE_BUCKETS)
+
+unmatched_topics_total = Counter('mqtt_unmatched_topics_total',
+                                 'Total count of MQTT messages not matching any gateway', [])
+
+decode_failures_total = Counter('mqtt_decode_failures_total',
+                                'Total count of MQTT payloads failed to decode',
+                                ['gateway', 'schema'])
+
+actuator_publishes_total = Counter('mqtt_actuator_publishes_total',
+                                   'Total count of MQTT publishes of actuator changes',
+                                   ['gateway'])
+
+actuator_publish_time = Histogram('mqtt_actuator_publish_duration_seconds',
+                                  'Time from an actuator change received from Laporte '
+                                  'until all its MQTT publishes are queued', ['gateway'],
+                                  buckets=STAGE_BUCKETS)
+
+LATENCY_BUCKETS = STAGE_BUCKETS + (2.5, 5.0, 10.0)
+
+message_latency = Histogram('mqtt_message_latency_seconds',
+                            'Time from a MQTT message received until its values are '
+                            'emitted to Laporte (after throttle windows, warmup, batches '
+                            'and the ack window)', ['gateway'],
+                            buckets=LATENCY_BUCKETS)
+
+actuator_latency = Histogram('mqtt_actuator_latency_seconds',
+                             'Time from an actuator change received from Laporte until '
+                             'its MQTT publish is completed (sent for QoS 0, '
+                             'acknowledged for QoS>0)', ['gateway'],
+                             buckets=LATENCY_BUCKETS)
+
+emit_ack_rtt = Histogram('mqtt_emit_ack_rtt_seconds',
+                         'Time from a Laporte emit until its acknowledgement',
+                         buckets=LATENCY_BUCKETS)
+
+last_message_age = GaugeSources(Gauge('mqtt_gateway_last_message_age_seconds',
+                                      'Time since the last MQTT message of a gateway',
+                                      ['gateway'],
+                                      multiprocess_mode='livemin'),
+                                combine=min)
+
+client_inflight_messages = GaugeSources(
+    Gauge('mqtt_client_inflight_messages',
+          'Count of QoS>0 messages in flight in MQTT client',
+          multiprocess_mode='livesum'))
+
+client_queued_messages = GaugeSources(
+    Gauge('mqtt_client_queued_messages',
+          'Count of outgoing messages queued in MQTT client',
+          multiprocess_mode='livesum'))
+
+
+def observe_stamps(stamps) -> None:
+    '''observe latencies of (histogram, receive time) stamps of emitted messages'''
+
+    if stamps:
+        now = monotonic()
+        for histogram, received in stamps:
+            histogram.observe(now - received)
+
+
+class GatewayMetrics():
+    '''metrics bound to labels of one gateway'''
+    def __init__(self, gateway_name, schema_name):
+        labels = (gateway_name, schema_name)
+        self.labels = labels
+        self.removed = False
+        self.match_time = stage_duration.labels('match', *labels)
+        self.decode_time = stage_duration.labels('decode', *labels)
+        self.emit_time = stage_duration.labels('emit', *labels)
+        self.decode_failures = decode_failures_total.labels(*labels)
+        self.latency = message_latency.labels(gateway_name)
+        self.actuator_latency = actuator_latency.labels(gateway_name)
+        self.last_message = monotonic()
+        self.messages = 0
+        last_message_age.add(self.get_last_message_age, gateway_name)
+
+    def get_last_message_age(self):
+        return monotonic() - self.last_message
+
+    def remove(self):
+        '''remove metrics of a gateway which is not configured anymore'''
+
+        gateway_name, _ = self.labels
+        for stage in ('match', 'decode', 'emit'):
+            stage_duration.remove(stage, *self.labels)
+        decode_failures_total.remove(*self.labels)
+        last_message_age.remove(self.get_last_message_age, gateway_name)
+        message_latency.remove(gateway_name)
+        actuator_latency.remove(gateway_name)
+        self.removed = True
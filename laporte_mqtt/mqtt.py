@@ -3,20 +3,40 @@
 Connect to a MQTT broker
 '''
 
-import re
 import logging
+import threading
 import time
-import json
+from typing import TYPE_CHECKING
+from collections import OrderedDict
+from time import perf_counter, monotonic
 from socket import gaierror
 import paho.mqtt.client as mqtt
 from laporte_mqtt.version import app_instance
 from laporte_mqtt.metrics import mqtt_message_time, mqtt_emits_total, mqtt_connects_total
-from laporte_mqtt.config import GatewaysConfig, SCHEMA_JSON, SCHEMA_VALUE
-from laporte_mqtt.laporte import Laporte
+from laporte_mqtt.metrics import mqtt_reconnect_attempts_total, mqtt_recover_time
+from laporte_mqtt.metrics import warmup_complete, outbox_depth, throttle_nodes
+from laporte_mqtt.metrics import (GatewayMetrics, unmatched_topics_total,
+                                  client_inflight_messages, client_queued_messages)
+from laporte_mqtt.config import GatewaysConfig, SCHEMA_NAMES
+from laporte_mqtt.router import TopicRouter, covering_filters
+from laporte_mqtt.pipeline import ShardedIngestQueue
+from laporte_mqtt.dedup import ChangeFilter
+from laporte_mqtt.throttle import Throttle
+from laporte_mqtt.warmup import Warmup
+from laporte_mqtt.outbox import Outbox
+from laporte_mqtt.backoff import Backoff
+from laporte_mqtt.capture import CaptureWriter
+from laporte_mqtt.msglog import message_log
+
+if TYPE_CHECKING:
+    # the Socket.IO client is imported by users of a Laporte client only
+    from laporte_mqtt.laporte import Laporte
 
 # create logger
 logging.getLogger(__name__).addHandler(logging.NullHandler())
 
+MAX_TRACED_PUBLISHES = 10000
+
 
 class MqttException(Exception):
     def __init__(self, message):
@@ -24,21 +44,191 @@ class MqttException(Exception):
 
 
 class Mqqt():
-    def __init__(self, gateways: GatewaysConfig, laporte: Laporte) -> None:
-        self.client = mqtt.Client(app_instance)
+    def __init__(self,
+                 gateways: GatewaysConfig,
+                 laporte: 'Laporte',
+                 sink=None,
+                 ingest: ShardedIngestQueue = None,
+                 dedup: ChangeFilter = None,
+                 client_id: str = app_instance,
+                 share_group: str = None,
+                 pinned: bool = True,
+                 max_inflight: int = 20,
+                 max_queued: int = 0,
+                 outbox_size: int = 0,
+                 backoff: Backoff = None,
+                 clean_session: bool = True,
+                 subscribe_qos: int = 0,
+                 warmup_quiet: float = 0.2,
+                 warmup_max: float = 10,
+                 capture: CaptureWriter = None,
+                 gateway_metrics: dict = None) -> None:
+        self.client = mqtt.Client(client_id, clean_session=clean_session)
+        self.client.max_inflight_messages_set(max_inflight)
+        self.client.max_queued_messages_set(max_queued)
         self.client.connected_flag = False
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
         self.client.on_publish = self.on_publish
+        self.client.on_subscribe = self.on_subscribe
         self.client.on_message = self.on_message
         self.gateways = gateways
+        self.router = TopicRouter(gateways.get())
+        self.gateway_metrics = {} if gateway_metrics is None else gateway_metrics
+        self.add_gateway_metrics(gateways)
         self.laporte = laporte
+        self.sink = laporte if sink is None else sink
+        self.ingest = ingest
+        self.dedup = dedup
+        self.capture = capture
+        self.throttle = Throttle(self.forward)
+        # collect retained messages replayed after a subscribe into bulk emits
+        self.warmup = None
+        if warmup_max > 0:
+            self.warmup = Warmup(self.forward, warmup_quiet, warmup_max)
+        self.share_group = share_group
+        self.pinned = pinned
+        # queue actuator publishes while the broker is disconnected
+        self.outbox = Outbox(outbox_size) if outbox_size > 0 else None
+        self.backoff = Backoff() if backoff is None else backoff
+        self.subscribe_qos = subscribe_qos
+        self.subscribed = []
+        self.disconnected_at = None
+        self.running = True
+        self.publish_lock = threading.Lock()
+        # start times of actuator publishes by mid, until on_publish
+        self.traced = OrderedDict()
+        self.trace_lock = threading.Lock()
+        client_inflight_messages.add(self.get_inflight_messages)
+        client_queued_messages.add(self.get_queued_messages)
+        warmup_complete.add(self.is_warm)
+
+    def get_inflight_messages(self):
+        return getattr(self.client, '_inflight_messages', 0)
+
+    def get_queued_messages(self):
+        return len(getattr(self.client, '_out_messages', ()))
+
+    def is_warm(self):
+        '''return False while retained messages of a subscribe are collected'''
+
+        return self.warmup is None or not self.warmup.active
+
+    def connect(self, host: str, port: int, keepalive=30, required=True):
+        '''
+        connect to the broker, return False if it failed and is not required
+        (the network loop keeps reconnecting then)
+        '''
 
-    def connect(self, host: str, port: int, keepalive=30):
         try:
             self.client.connect(host, port, keepalive)
         except (ConnectionRefusedError, OSError, gaierror) as exc:
-            raise MqttException(exc) from exc
+            if required:
+                raise MqttException(exc) from exc
+            logging.error("MQTT connect to %s:%s failed: %s", host, port, exc)
+            return False
+        return True
+
+    def stop(self):
+        '''disconnect and finish the network loop, throttle and warmup threads'''
+
+        self.running = False
+        self.client.disconnect()
+        self.throttle.stop()
+        if self.warmup is not None:
+            self.warmup.stop()
+
+        # gauges of all clients show running ones only
+        client_inflight_messages.remove(self.get_inflight_messages)
+        client_queued_messages.remove(self.get_queued_messages)
+        warmup_complete.remove(self.is_warm)
+        throttle_nodes.remove(self.throttle.__len__)
+        if self.outbox is not None:
+            outbox_depth.remove(self.outbox.__len__)
+
+    def get_client(self, gateway):
+        '''return the client connected to the broker of a gateway'''
+
+        del gateway  # Ignored parameter
+        return self
+
+    def subscription(self, gateway):
+        '''
+        return a topic filter to subscribe the gateway with
+        (a shared subscription if share group is set),
+        None if the gateway is pinned to another process
+        '''
+
+        if self.share_group is None:
+            return gateway.subscribe_topic
+        if gateway.subscribe_shared:
+            return f'$share/{self.share_group}/{gateway.subscribe_topic}'
+        if self.pinned:
+            return gateway.subscribe_topic
+        return None
+
+    def subscriptions(self, gateways):
+        '''
+        return a minimal list of topic filters to subscribe gateways with,
+        filters covered by another one are left out (the router dispatches
+        a message to all gateways it matches)
+        '''
+
+        ret = []
+        for gateway in gateways.get():
+            topic = self.subscription(gateway)
+            if topic is not None and topic not in ret:
+                ret.append(topic)
+
+        covering = covering_filters(ret)
+        if len(covering) < len(ret):
+            logging.info("MQTT topic filters %s covered by %s",
+                         [topic for topic in ret if topic not in covering], covering)
+        return covering
+
+    def add_gateway_metrics(self, gateways):
+        '''bind metrics to gateways not seen yet'''
+
+        for gateway in gateways.get():
+            metrics = self.gateway_metrics.get(gateway.name)
+            if metrics is None or metrics.removed:
+                self.gateway_metrics[gateway.name] = GatewayMetrics(
+                    gateway.name, SCHEMA_NAMES.get(gateway.subscribe_schema))
+
+    def set_gateways(self, gateways: GatewaysConfig):
+        '''swap in gateways served by this client and sync subscriptions'''
+
+        router = TopicRouter(gateways.get())
+
+        # metrics first, so every gateway of a routed message has them
+        self.add_gateway_metrics(gateways)
+        self.gateways = gateways
+        self.router = router
+
+        if self.is_connected():
+            self.sync_subscriptions()
+
+    def sync_subscriptions(self):
+        '''
+        subscribe/unsubscribe topic filters changed against the broker session,
+        each in one multi-topic packet
+        '''
+
+        topics = self.subscriptions(self.gateways)
+        unsubscribe = [topic for topic in self.subscribed if topic not in topics]
+        subscribe = [topic for topic in topics if topic not in self.subscribed]
+        self.subscribed = topics
+
+        # subscribe first, so no message falls between a dropped covering filter
+        # and filters replacing it (an overlap delivers a message twice at worst)
+        if subscribe:
+            logging.info("MQTT subscribe %s", subscribe)
+            if self.warmup is not None:
+                self.warmup.start()
+            self.client.subscribe([(topic, self.subscribe_qos) for topic in subscribe])
+        if unsubscribe:
+            logging.info("MQTT unsubscribe %s", unsubscribe)
+            self.client.unsubscribe(unsubscribe)
 
     def is_connected(self):
         return self.client.connected_flag
@@ -58,14 +248,25 @@ class Mqqt():
         '''
 
         if ret == 0:
-            self.client.connected_flag = True
+            with self.publish_lock:
+                self.client.connected_flag = True
+                self.flush_outbox()
             logging.info("MQTT connected OK")
             logging.debug("userdata=%s, flags=%s, ret=%s", userdata, flags, ret)
+            self.backoff.reset()
+            if self.disconnected_at is not None:
+                mqtt_recover_time.observe(monotonic() - self.disconnected_at)
+                self.disconnected_at = None
 
-            # subscribe mqtt topics
-            for gateway in self.gateways.get():
-                logging.info("MQTT subscribe %s", gateway.subscribe_topic)
-                self.client.subscribe(gateway.subscribe_topic)
+            if self.warmup is not None:
+                self.warmup.connected()
+
+            # a persistent session keeps subscriptions, else subscribe all topics
+            if flags.get('session present'):
+                logging.info("MQTT session resumed")
+            else:
+                self.subscribed = []
+            self.sync_subscriptions()
 
             # connects / reconnects counter
             mqtt_connects_total.inc()
@@ -76,6 +277,8 @@ class Mqqt():
         '''fired upon a disconnection'''
 
         self.client.connected_flag = False
+        if self.disconnected_at is None:
+            self.disconnected_at = monotonic()
         logging.error("MQTT disconnect")
         logging.debug("userdata=%s, ret=%s", userdata, ret)
 
@@ -85,47 +288,188 @@ class Mqqt():
         del client  # Ignored parameter
         mqtt_emits_total.inc()
         logging.debug("MQTT published: userdata=%s, mid=%s", userdata, mid)
+        self.publish_done(mid)
+
+    def on_subscribe(self, client, userdata, mid, granted_qos):
+        '''fired upon a subscribe acknowledged'''
+
+        del client  # Ignored parameter
+        logging.debug("MQTT subscribed: userdata=%s, mid=%s, qos=%s", userdata, mid,
+                      granted_qos)
+        if self.warmup is not None:
+            self.warmup.acked()
 
-    @mqtt_message_time.time()
     def on_message(self, client, userdata, msg):
         '''receive message from MQTT'''
 
         del client  # Ignored parameter
-        logging.info("MQTT receive: %s %s", msg.topic, msg.payload)
+        message_log.info(msg.topic, "MQTT receive: %s %s", msg.topic, msg.payload)
         logging.debug("userdata=%s", userdata)
 
-        for gateway in self.gateways.get():
-            pattern = gateway.subscribe_pattern.format("(.*)", "(.*)")
-            match_obj = re.match(pattern, msg.topic)
-            if match_obj:
-                groups = match_obj.groups()
-                if (gateway.subscribe_schema == SCHEMA_JSON) and (len(groups) == 1):
-                    node_addr = groups[0]
-                    message = {node_addr: json.loads(msg.payload)}
-                    break
-                if (gateway.subscribe_schema == SCHEMA_VALUE) and (len(groups) == 2):
-                    node_addr = groups[0]
-                    key = groups[1]
-                    message = {node_addr: {key: msg.payload.decode('ascii')}}
-                    break
-
-        if match_obj:
-            self.laporte.emit("sensor_addr_response", message)
+        if self.capture is not None:
+            self.capture.write(msg)
+
+        if self.ingest is None:
+            # an error must not end the network loop (and its reconnects)
+            try:
+                self.process_message(msg)
+            except Exception as exc:  # pylint: disable=broad-except
+                logging.error("MQTT message %s processing failed: %s", msg.topic, exc)
         else:
-            logging.warning("MQTT topic %s not match any gateway", msg.topic)
+            self.ingest.put(msg, self.process_message)
+
+    @mqtt_message_time.time()
+    def process_message(self, msg):
+        '''route and decode a received message and emit it to Laporte'''
+
+        start = perf_counter()
+        routes = self.router.match(msg.topic)
+        matched = perf_counter()
+        if not routes:
+            unmatched_topics_total.inc()
+            message_log.warning(msg.topic, "MQTT topic %s not match any gateway", msg.topic)
+            return
+
+        # one delivery is dispatched once to every matching gateway
+        for route in routes:
+            self.process_route(msg, route, matched - start)
+
+    def process_route(self, msg, route, match_time):
+        '''decode a received message for a matched gateway and emit it to Laporte'''
+
+        start = perf_counter()
+        metrics = self.gateway_metrics[route.gateway.name]
+        metrics.last_message = monotonic()
+        metrics.messages += 1
+        metrics.match_time.observe(match_time)
+
+        # skip decoding of a single value out of the whitelist
+        transform = route.gateway.subscribe_transform
+        if transform is not None and route.key is not None:
+            if not transform.accepts(route.key):
+                return
+
+        try:
+            message = route.gateway.subscribe_codec.decode(msg.payload, route.node_addr,
+                                                           route.key)
+        except ValueError as exc:
+            metrics.decode_failures.inc()
+            logging.error("MQTT payload of %s decode failed: %s", msg.topic, exc)
+            return
+
+        if transform is not None:
+            for node_addr, values in list(message.items()):
+                if isinstance(values, dict):
+                    values = transform.apply(values)
+                    if values:
+                        message[node_addr] = values
+                    else:
+                        del message[node_addr]
+            if not message:
+                return
+
+        metrics.decode_time.observe(perf_counter() - start)
+
+        # the receive time goes with the values through the emit stages,
+        # the latency is observed as the Laporte client emits them
+        stamps = [(metrics.latency, msg.timestamp)] if msg.timestamp else None
+
+        # retained messages of a warmup are emitted in a bulk snapshot,
+        # a live message supersedes their values
+        if self.warmup is not None:
+            if msg.retain:
+                if self.warmup.add(route.gateway.name, message, stamps):
+                    return
+            else:
+                self.warmup.discard(route.gateway.name, message)
+
+        if route.gateway.subscribe_throttle is None:
+            self.forward(route.gateway.name, message, stamps)
+        else:
+            self.throttle.add(route.gateway, message, stamps)
+
+    def forward(self, gateway_name, message, stamps=None):
+        '''filter unchanged values of a decoded message and emit it to Laporte'''
+
+        if self.dedup is not None:
+            message = self.dedup.filter(gateway_name, message)
+            if not message:
+                return
+
+        start = perf_counter()
+        self.sink.emit("sensor_addr_response", message, stamps=stamps)
+        self.gateway_metrics[gateway_name].emit_time.observe(perf_counter() - start)
+
+    def reconnect(self):
+        '''reconnect with exponential backoff and jitter'''
+
+        nattempts = 0
+        while self.running:
+            time.sleep(self.backoff.next())
+            nattempts += 1
+            mqtt_reconnect_attempts_total.inc()
+            try:
+                self.client.reconnect()
+            except (ConnectionRefusedError, OSError, gaierror) as exc:
+                logging.error("MQTT reconnect failed (attempt=%s): %s", nattempts, exc)
+            else:
+                return
 
     def loop(self):
-        self.client.loop_start()
-
-        while True:
-            nattempts = 0
-            while not self.is_connected():
-                if nattempts > 0:
-                    logging.error("MQTT connect wait... (attempt=%s)", nattempts)
-                time.sleep(10)
-                nattempts += 1
-            time.sleep(1)
-
-    def publish(self, topic, payload):
-        logging.info("MQTT publish: %s %s", topic, payload)
-        self.client.publish(topic, payload)
+        '''network loop: process MQTT traffic, reconnect as soon as it is lost'''
+
+        while self.running:
+            ret = self.client.loop(timeout=1.0)
+            if ret != mqtt.MQTT_ERR_SUCCESS and self.running:
+                if self.disconnected_at is None:
+                    self.disconnected_at = monotonic()
+                self.reconnect()
+
+    def flush_outbox(self):
+        '''publish commands queued while disconnected (call with publish lock held)'''
+
+        if self.outbox is None:
+            return
+        messages = self.outbox.take()
+        if messages:
+            logging.info("MQTT publish %s queued messages", len(messages))
+        for topic, payload, qos, retain in messages:
+            self.client.publish(topic, payload, qos, retain)
+
+    def trace_publish(self, info, gateway_name, start):
+        '''time a publish of an actuator change (perf_counter start) until its on_publish'''
+
+        if info is None:  # queued in the outbox
+            return
+        # not connected or the queue of paho full (is_published() would raise)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            logging.error("MQTT publish of %s failed: %s", gateway_name,
+                          mqtt.error_string(info.rc))
+            return
+        with self.trace_lock:
+            self.traced[info.mid] = (start, gateway_name)
+            if len(self.traced) > MAX_TRACED_PUBLISHES:
+                self.traced.popitem(last=False)
+
+        # on_publish of QoS 0 may come before the mid is known
+        if info.is_published():
+            self.publish_done(info.mid)
+
+    def publish_done(self, mid):
+        '''observe the latency of a traced publish'''
+
+        with self.trace_lock:
+            traced = self.traced.pop(mid, None)
+        if traced is not None:
+            start, gateway_name = traced
+            metrics = self.gateway_metrics.get(gateway_name)
+            if metrics is not None:
+                metrics.actuator_latency.observe(perf_counter() - start)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        message_log.info(topic, "MQTT publish: %s %s", topic, payload)
+        with self.publish_lock:
+            if self.outbox is not None and not self.is_connected():
+                self.outbox.put(topic, payload, qos, retain)
+                return None
+            return self.client.publish(topic, payload, qos, retain)
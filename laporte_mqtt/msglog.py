@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+'''
+Rate-limited logging of per-message lines and periodic summaries
+'''
+
+import logging
+import threading
+from time import monotonic
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+MAX_TOPICS = 10000
+
+
+class MessageLog():
+    '''
+    Log lines of the message hot path capped per topic
+    with a token bucket of rate lines per minute (0 is unlimited)
+    '''
+    def __init__(self, rate: int = 0) -> None:
+        self.rate = rate
+        self.buckets = {}
+        self.suppressed = 0
+
+    def allow(self, topic) -> bool:
+        '''take a token of the topic bucket'''
+
+        now = monotonic()
+        bucket = self.buckets.get(topic)
+        if bucket is None:
+            if len(self.buckets) >= MAX_TOPICS:
+                self.buckets.clear()
+            self.buckets[topic] = [self.rate - 1, now]
+            return True
+
+        tokens = min(self.rate, bucket[0] + (now - bucket[1]) * self.rate / 60)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            self.suppressed += 1
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+    def log(self, level, topic, msg, *args) -> None:
+        if not logging.root.isEnabledFor(level):
+            return
+        if self.rate and not self.allow(topic):
+            return
+        logging.log(level, msg, *args, stacklevel=3)
+
+    def info(self, topic, msg, *args) -> None:
+        self.log(logging.INFO, topic, msg, *args)
+
+    def warning(self, topic, msg, *args) -> None:
+        self.log(logging.WARNING, topic, msg, *args)
+
+
+class MessageSummary():
+    '''periodic summary line of received messages per gateway'''
+    def __init__(self, gateway_metrics: dict, interval: float) -> None:
+        self.gateway_metrics = gateway_metrics
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def loop(self):
+        last = {}
+        last_suppressed = 0
+        last_time = monotonic()
+        while not self.stopped.wait(self.interval):
+            now = monotonic()
+            elapsed = now - last_time
+            rates = []
+            for name, metrics in list(self.gateway_metrics.items()):
+                if metrics.removed:
+                    continue
+                rates.append(f"{name} {(metrics.messages - last.get(name, 0)) / elapsed:.1f}")
+                last[name] = metrics.messages
+            suppressed = message_log.suppressed - last_suppressed
+            last_suppressed = message_log.suppressed
+            last_time = now
+            logging.info("MQTT msgs/s: %s (%s message log lines suppressed)",
+                         ', '.join(rates), suppressed)
+
+
+message_log = MessageLog()
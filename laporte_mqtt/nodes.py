@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+'''
+Registry of node identities shared by per-node state
+'''
+
+import sys
+import logging
+import threading
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+MAX_NODES_DEFAULT = 1000000
+
+
+def intern(value):
+    '''return an interned string (values of other types unchanged)'''
+
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
+class NodeRegistry():
+    '''
+    Canonical (gateway, node_addr) tuples with interned strings, used as
+    keys of per-node state (change filter, throttle windows), so a node
+    costs its identity once however many structures refer to it.
+    Above max_nodes the registry starts over, which only loses sharing.
+    '''
+    def __init__(self, max_nodes: int = MAX_NODES_DEFAULT) -> None:
+        self.max_nodes = max_nodes
+        self.nodes = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def node(self, gateway_name, node_addr) -> tuple:
+        '''return the canonical identity of a node'''
+
+        item = (gateway_name, node_addr)
+        ret = self.nodes.get(item)
+        if ret is None:
+            ret = (intern(gateway_name), intern(node_addr))
+            with self.lock:
+                if len(self.nodes) >= self.max_nodes:
+                    self.nodes.clear()
+                ret = self.nodes.setdefault(ret, ret)
+        return ret
+
+
+node_registry = NodeRegistry()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+'''
+Outbound queue of actuator publishes while the MQTT broker is unreachable
+'''
+
+import logging
+import threading
+from collections import OrderedDict
+from laporte_mqtt.metrics import outbox_depth, outbox_dropped_total
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+class Outbox():
+    '''
+    Bounded queue of publishes coalesced by topic: the latest command
+    for a topic replaces an older one and moves to the end of the queue.
+    Above maxsize the oldest command is dropped.
+    '''
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.messages = OrderedDict()
+        self.lock = threading.Lock()
+        outbox_depth.add(self.__len__)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def put(self, topic, payload, qos=0, retain=False):
+        '''queue a publish'''
+
+        with self.lock:
+            if topic in self.messages:
+                del self.messages[topic]
+                outbox_dropped_total.labels('coalesced').inc()
+            elif len(self.messages) >= self.maxsize:
+                old_topic, _ = self.messages.popitem(last=False)
+                outbox_dropped_total.labels('overflow').inc()
+                logging.warning("MQTT outbox full, publish to %s dropped", old_topic)
+            self.messages[topic] = (payload, qos, retain)
+
+    def take(self):
+        '''return queued publishes in order and empty the queue'''
+
+        with self.lock:
+            ret = [(topic, *message) for topic, message in self.messages.items()]
+            self.messages.clear()
+        return ret
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+'''
+Bounded ingest queues between the paho network thread and worker threads
+'''
+
+import logging
+import threading
+from collections import deque
+from laporte_mqtt.policies import POLICIES, POLICY_BLOCK, POLICY_COALESCE
+from laporte_mqtt.metrics import (ingest_queue_depth, ingest_dropped_total,
+                                  ingest_coalesced_total)
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+class IngestQueue():
+    '''
+    Bounded FIFO of received MQTT messages, each one with a handler
+    of the client it came from, with an overflow policy:
+
+    block: the producer waits for a free slot
+    drop-oldest: the oldest queued message is dropped
+    coalesce: a queued message of the same topic (and client) is replaced
+        in place by the latest one, a full queue then drops the oldest message
+    '''
+    def __init__(self, maxsize=10000, policy=POLICY_BLOCK):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown overflow policy {policy}")
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self.entries = deque()
+        self.topics = {}
+        self.closed = False
+        self.cond = threading.Condition()
+        ingest_queue_depth.add(self.__len__)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, msg, handler):
+        '''enqueue a message to process by handler with respect to the overflow policy'''
+
+        key = (handler, msg.topic)
+        with self.cond:
+            if self.policy == POLICY_COALESCE:
+                entry = self.topics.get(key)
+                if entry is not None:
+                    entry[1] = msg
+                    ingest_coalesced_total.inc()
+                    return
+
+            if len(self.entries) >= self.maxsize:
+                if self.policy == POLICY_BLOCK:
+                    while len(self.entries) >= self.maxsize and not self.closed:
+                        self.cond.wait()
+                else:
+                    self._drop_oldest()
+
+            entry = [key, msg]
+            self.entries.append(entry)
+            if self.policy == POLICY_COALESCE:
+                self.topics[key] = entry
+            self.cond.notify_all()
+
+    def _drop_oldest(self):
+        '''drop the first queued message (call with the lock held)'''
+
+        key, msg = self.entries.popleft()
+        if self.policy == POLICY_COALESCE:
+            del self.topics[key]
+        ingest_dropped_total.inc()
+        logging.warning("MQTT ingest queue full, message %s dropped", msg.topic)
+
+    def get(self):
+        '''
+        dequeue a message and its handler, wait until there is one
+        (return None if the queue is closed and empty)
+        '''
+
+        with self.cond:
+            while not self.entries and not self.closed:
+                self.cond.wait()
+            if not self.entries:
+                return None
+            key, msg = self.entries.popleft()
+            if self.policy == POLICY_COALESCE:
+                del self.topics[key]
+            self.cond.notify_all()
+
+        return msg, key[0]
+
+    def close(self):
+        '''let consumers finish once queued messages are taken'''
+
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        ingest_queue_depth.remove(self.__len__)
+
+
+class ShardedIngestQueue():
+    '''
+    Ingest queues of worker threads (maxsize split among them), messages
+    of one topic always go to the same queue, so they are processed in
+    the order of arrival
+    '''
+    def __init__(self, maxsize=10000, policy=POLICY_BLOCK, shards=1):
+        size = -(-maxsize // shards)
+        self.shards = [IngestQueue(size, policy) for _ in range(shards)]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def put(self, msg, handler):
+        '''enqueue a message to the queue of its topic'''
+
+        self.shards[hash(msg.topic) % len(self.shards)].put(msg, handler)
+
+
+class IngestWorkers():
+    '''threads processing messages taken from ingest queues, one per queue'''
+    def __init__(self, queue: ShardedIngestQueue):
+        self.queue = queue
+        self.threads = [
+            threading.Thread(target=self.loop, args=(shard, ), name=f'ingest-{i}', daemon=True)
+            for i, shard in enumerate(queue.shards)
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        '''process queued messages and finish the threads'''
+
+        for shard in self.queue.shards:
+            shard.close()
+        for thread in self.threads:
+            if thread.is_alive():
+                thread.join()
+
+    @staticmethod
+    def loop(shard):
+        '''process queued messages until the queue is closed'''
+
+        while True:
+            entry = shard.get()
+            if entry is None:
+                return
+            msg, handler = entry
+            try:
+                handler(msg)
+            except Exception as exc:  # pylint: disable=broad-except
+                logging.error("MQTT message %s processing failed: %s", msg.topic, exc)
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+'''
+Overload policies of the ingest queue and the emit flow control
+'''
+
+POLICY_BLOCK = 'block'
+POLICY_DROP_OLDEST = 'drop-oldest'
+POLICY_COALESCE = 'coalesce'
+# ingest queue overflow
+POLICIES = [POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_COALESCE]
+# full ack window of emits
+FLOW_POLICIES = [POLICY_BLOCK, POLICY_COALESCE]
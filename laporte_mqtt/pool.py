@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+'''
+Pool of MQTT clients connected to brokers named by gateways
+'''
+
+import copy
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from laporte_mqtt.config import GatewaysConfig
+from laporte_mqtt.mqtt import Mqqt
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+MQTT_PORT = 1883
+
+
+def parse_broker(broker: str) -> tuple:
+    '''return (host, port) of a host[:port] broker address'''
+
+    host, sep, port = broker.rpartition(':')
+    if sep and port.isdigit():
+        return host.strip('[]'), int(port)
+    return broker, MQTT_PORT
+
+
+class MqttPool():
+    '''
+    MQTT clients, one per broker named by the gateways config (gateways
+    without a broker use the default one), each running its own network
+    loop. All clients feed one Laporte client, one emit sink and one set
+    of metrics; a config reload connects added brokers and disconnects
+    the unused ones.
+    '''
+    def __init__(self,
+                 gateways: GatewaysConfig,
+                 laporte,
+                 default_broker: tuple,
+                 client_class=Mqqt,
+                 **kwargs) -> None:
+        self.gateways = gateways
+        self.laporte = laporte
+        self.default_broker = default_broker
+        self.client_class = client_class
+        self.kwargs = kwargs
+        self.gateway_metrics = {}
+        self.clients = OrderedDict()
+        self.keepalive = 30
+        self.lock = threading.Lock()
+        self.loop = None
+        self.failed = None
+        self.tasks = {}
+
+        for address, subset in self.split(gateways).items():
+            self.clients[address] = self.create_client(subset)
+
+    def get_clients(self) -> list:
+        return list(self.clients.values())
+
+    def split(self, gateways: GatewaysConfig) -> OrderedDict:
+        '''return gateways grouped by a (host, port) broker address'''
+
+        names = OrderedDict()
+        for gateway in gateways.get():
+            address = self.default_broker
+            if gateway.broker is not None:
+                address = parse_broker(gateway.broker)
+            names.setdefault(address, []).append(gateway.name)
+
+        return OrderedDict((address, gateways.subset(gateway_names))
+                           for address, gateway_names in names.items())
+
+    def create_client(self, gateways: GatewaysConfig):
+        '''create a client serving given gateways'''
+
+        kwargs = dict(self.kwargs)
+        # backoff keeps a state of the client reconnects
+        if kwargs.get('backoff') is not None:
+            kwargs['backoff'] = copy.copy(kwargs['backoff'])
+        return self.client_class(gateways,
+                                 self.laporte,
+                                 gateway_metrics=self.gateway_metrics,
+                                 **kwargs)
+
+    def get_client(self, gateway):
+        '''return the client connected to the broker of a gateway'''
+
+        for client in self.get_clients():
+            if gateway.name in client.gateways.gateway_map:
+                return client
+        raise KeyError(f"no MQTT client of gateway {gateway.name}")
+
+    def connect(self, keepalive=30):
+        '''connect clients to their brokers, only the default broker is required'''
+
+        self.keepalive = keepalive
+        for address, client in self.clients.items():
+            client.connect(*address, keepalive, required=address == self.default_broker)
+
+    def start_client(self, address, client, required=False):
+        '''run a network loop of a client (a thread or an event loop task)'''
+
+        host, port = address
+        if self.loop is None:
+            threading.Thread(target=client.loop, name=f'mqtt-{host}:{port}').start()
+            return
+
+        task = self.loop.create_task(
+            client.run(host, port, self.keepalive, required))
+        task.add_done_callback(self._finished)
+        self.tasks[address] = task
+
+    def _finished(self, task):
+        '''pass an error of a client task to run()'''
+
+        if not task.cancelled() and task.exception() is not None:
+            if not self.failed.done():
+                self.failed.set_exception(task.exception())
+
+    def start(self):
+        '''start network loops of connected clients in threads'''
+
+        for address, client in self.clients.items():
+            self.start_client(address, client, required=address == self.default_broker)
+
+    async def run(self, keepalive=30):
+        '''run clients on the event loop, raise an error of a required one'''
+
+        self.keepalive = keepalive
+        self.loop = asyncio.get_running_loop()
+        self.failed = self.loop.create_future()
+        self.start()
+        await self.failed
+
+    def stop(self):
+        '''disconnect clients, their network loops and run() finish then'''
+
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._stop)
+        else:
+            self._stop()
+
+    def _stop(self):
+        with self.lock:
+            for client in self.get_clients():
+                client.stop()
+        if self.failed is not None and not self.failed.done():
+            self.failed.set_result(None)
+
+    def apply_gateways(self, gateways: GatewaysConfig):
+        '''swap in a new gateways config, connect/disconnect changed brokers'''
+
+        with self.lock:
+            split = self.split(gateways)
+
+            for address, client in list(self.clients.items()):
+                if address not in split:
+                    logging.info("MQTT broker %s:%s not used anymore", *address)
+                    client.set_gateways(gateways.subset([]))
+                    client.stop()
+                    del self.clients[address]
+                    self.tasks.pop(address, None)
+
+            for address, subset in split.items():
+                client = self.clients.get(address)
+                if client is not None:
+                    client.set_gateways(subset)
+                    continue
+
+                logging.info("MQTT broker %s:%s added", *address)
+                client = self.create_client(subset)
+                self.clients[address] = client
+                if self.loop is None:
+                    client.connect(*address, self.keepalive, required=False)
+                self.start_client(address, client)
+
+            self.gateways = gateways
+
+            # messages of removed gateways may be still in processing,
+            # so their metrics are only unregistered
+            names = list(gateways.get_names())
+            for name, metrics in self.gateway_metrics.items():
+                if name not in names and not metrics.removed:
+                    metrics.remove()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+'''
+On-demand stack sampling profiler served next to the metrics exporter
+'''
+
+import sys
+import logging
+import threading
+from time import monotonic, sleep
+from collections import Counter
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+from prometheus_client import REGISTRY, make_wsgi_app
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+PROFILE_PATH = '/profile'
+PROFILE_SECONDS_DEFAULT = 10
+PROFILE_SECONDS_MAX = 300
+SAMPLE_INTERVAL = 0.005
+
+
+class StackSampler():
+    '''
+    Wall-clock profiler sampling stacks of all threads, the result is
+    a count of samples per stack in the folded format of flame graph
+    tools ("thread;outer;...;inner count").
+    '''
+    def __init__(self, interval: float = SAMPLE_INTERVAL) -> None:
+        self.interval = interval
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def fold(thread_name, frame) -> str:
+        '''return a stack of a frame as one line'''
+
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            module = frame.f_globals.get('__name__', '?')
+            names.append(f"{module}.{getattr(code, 'co_qualname', code.co_name)}")
+            frame = frame.f_back
+        names.append(thread_name)
+        return ';'.join(reversed(names))
+
+    def sample(self, seconds: float) -> Counter:
+        '''sample stacks for given seconds, return None if a profile is running'''
+
+        if not self.lock.acquire(blocking=False):
+            return None
+
+        try:
+            own = threading.get_ident()
+            stacks = Counter()
+            deadline = monotonic() + seconds
+            while monotonic() < deadline:
+                threads = {thread.ident: thread.name for thread in threading.enumerate()}
+                # pylint: disable=protected-access
+                for ident, frame in sys._current_frames().items():
+                    if ident != own:
+                        stacks[self.fold(threads.get(ident, str(ident)), frame)] += 1
+                sleep(self.interval)
+            return stacks
+        finally:
+            self.lock.release()
+
+
+class ProfilerApp():
+    '''
+    WSGI app serving prometheus metrics and a stack profile
+    of PROFILE_PATH?seconds=N
+    '''
+    def __init__(self, registry=REGISTRY, sampler: StackSampler = None) -> None:
+        self.metrics_app = make_wsgi_app(registry)
+        self.sampler = StackSampler() if sampler is None else sampler
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') != PROFILE_PATH:
+            return self.metrics_app(environ, start_response)
+
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        try:
+            seconds = float(query.get('seconds', [PROFILE_SECONDS_DEFAULT])[0])
+        except ValueError:
+            return self.respond(start_response, '400 Bad Request', 'invalid seconds\n')
+        seconds = min(max(seconds, 0), PROFILE_SECONDS_MAX)
+
+        logging.info("profiling for %s s", seconds)
+        stacks = self.sampler.sample(seconds)
+        if stacks is None:
+            return self.respond(start_response, '409 Conflict', 'profile already running\n')
+
+        lines = [f'{stack} {count}\n' for stack, count in stacks.most_common()]
+        return self.respond(start_response, '200 OK', ''.join(lines))
+
+    @staticmethod
+    def respond(start_response, status, text):
+        body = text.encode('utf8')
+        start_response(status, [('Content-Type', 'text/plain; charset=utf-8'),
+                                ('Content-Length', str(len(body)))])
+        return [body]
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    '''WSGI server handling a request per thread (a profile blocks it)'''
+
+    daemon_threads = True
+
+
+class SilentHandler(WSGIRequestHandler):
+    '''request handler without access log'''
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+def start_http_server(port: int, addr: str = '0.0.0.0', registry=REGISTRY):
+    '''start a server of metrics and the profiler in a daemon thread'''
+
+    httpd = make_server(addr,
+                        port,
+                        ProfilerApp(registry),
+                        ThreadingWSGIServer,
+                        handler_class=SilentHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+'''
+Hot reload of the gateways config
+'''
+
+import os
+import logging
+import threading
+from laporte_mqtt.config import GatewaysConfig
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+class ConfigReloader():
+    '''
+    Reload the gateways config file on demand (SIGHUP) or when its
+    modification time changes and pass the new config to a handler.
+    An invalid config is reported and the current one is kept.
+    Requests of a signal handler are served by the watch() thread, so a
+    signal never runs (or re-enters) a reload.
+    '''
+    def __init__(self, filename: str, handler) -> None:
+        self.filename = filename
+        self.handler = handler
+        self.mtime = self.get_mtime()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.requested = threading.Event()
+
+    def get_mtime(self):
+        try:
+            return os.stat(self.filename).st_mtime_ns
+        except OSError:
+            return None
+
+    def reload(self, *_) -> None:
+        '''load the config file and apply it'''
+
+        with self.lock:
+            self.mtime = self.get_mtime()
+            try:
+                gateways = GatewaysConfig(self.filename, exit_on_error=False)
+            except Exception as exc:  # pylint: disable=broad-except
+                # any error of loading (also a SIGHUP handler) keeps the current config
+                logging.error("gateways config reload failed, keeping current: %s", exc)
+                return
+
+            logging.info("gateways config reloaded: %s", list(gateways.get_names()))
+            self.handler(gateways)
+
+    def check(self) -> None:
+        '''reload the config file if it was modified'''
+
+        mtime = self.get_mtime()
+        if mtime is not None and mtime != self.mtime:
+            self.reload()
+
+    def request(self, *_) -> None:
+        '''ask watch() to reload the config file (a signal handler)'''
+
+        self.requested.set()
+
+    def watch(self, interval: float) -> None:
+        '''
+        reload the config file on a request and check it for modifications
+        every interval seconds (requests only if 0) until stop()
+        '''
+
+        while True:
+            requested = self.requested.wait(interval if interval > 0 else None)
+            if self.stopped.is_set():
+                return
+            # requests coming during a reload are served by one more reload
+            self.requested.clear()
+            try:
+                if requested:
+                    self.reload()
+                else:
+                    self.check()
+            except Exception as exc:  # pylint: disable=broad-except
+                logging.error("gateways config reload failed: %s", exc)
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.requested.set()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+'''
+Replay a capture of MQTT messages through the bridge pipeline
+
+Feeds captured messages into routing, decoding and the emit stages of the
+bridge (a stub Laporte client serializes emits like Socket.IO does) at
+the captured pace, N times faster or as fast as possible, and reports
+throughput and per-stage timing.
+
+usage: laporte-mqtt-replay [options] capture_file
+'''
+
+import sys
+import json
+import logging
+import threading
+from argparse import ArgumentParser
+from time import monotonic, perf_counter, sleep
+import paho.mqtt.client as mqtt
+from laporte_mqtt.capture import read_capture
+from laporte_mqtt.config import GatewaysConfig
+from laporte_mqtt.mqtt import Mqqt
+from laporte_mqtt.batcher import EmitBatcher
+from laporte_mqtt.dedup import ChangeFilter
+from laporte_mqtt.metrics import stage_duration
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+CONFIG_FILE_DEFAULT = 'conf/gateways.yml'
+STAGES = ('match', 'decode', 'emit')
+
+
+class StubLaporte():
+    '''Laporte client stand-in counting emits and their JSON size'''
+    def __init__(self) -> None:
+        self.emits = 0
+        self.nodes = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def emit(self, response, message, stamps=None):
+        del stamps  # Ignored parameters
+        data = json.dumps([response, message])
+        with self.lock:
+            self.emits += 1
+            self.nodes += len(message)
+            self.bytes += len(data)
+
+    @staticmethod
+    def is_connected() -> bool:
+        return True
+
+
+def replay(bridge, records, speed: float = 1.0):
+    '''feed (timestamp, topic, payload, retain) records, return the message count'''
+
+    count = 0
+    first = None
+    start = monotonic()
+    for timestamp, topic, payload, retain in records:
+        if speed > 0:
+            if first is None:
+                first = timestamp
+            delay = start + (timestamp - first) / speed - monotonic()
+            if delay > 0:
+                sleep(delay)
+
+        msg = mqtt.MQTTMessage(topic=topic.encode('utf8'))
+        msg.payload = payload
+        msg.retain = retain
+        msg.timestamp = monotonic()
+        bridge.process_message(msg)
+        count += 1
+    return count
+
+
+def bucket_quantile(buckets, count, quantile):
+    '''upper bound of a histogram bucket holding the quantile'''
+
+    for bound, cumulative in buckets:
+        if cumulative >= quantile * count:
+            return bound
+    return float('inf')
+
+
+def stage_stats():
+    '''return {(stage, gateway): (count, mean, p50, p99)} of stage durations'''
+
+    counts, sums, buckets = {}, {}, {}
+    for family in stage_duration.collect():
+        for sample in family.samples:
+            item = (sample.labels['stage'], sample.labels['gateway'])
+            if sample.name.endswith('_count'):
+                counts[item] = sample.value
+            elif sample.name.endswith('_sum'):
+                sums[item] = sample.value
+            elif sample.name.endswith('_bucket'):
+                buckets.setdefault(item, []).append(
+                    (float(sample.labels['le']), sample.value))
+
+    ret = {}
+    for item, count in counts.items():
+        if count:
+            ret[item] = (count, sums[item] / count, bucket_quantile(buckets[item], count, .5),
+                         bucket_quantile(buckets[item], count, .99))
+    return ret
+
+
+def main():
+    parser = ArgumentParser(description='replay a capture of MQTT messages through '
+                            'the laporte-mqtt pipeline')
+    parser.add_argument('capture_file', help='file written with --capture-file')
+    parser.add_argument('-c',
+                        '--gateways-config-file',
+                        dest='config_file',
+                        default=CONFIG_FILE_DEFAULT,
+                        help=f'yaml file with gateways configuration '
+                        f'(default {CONFIG_FILE_DEFAULT})')
+    parser.add_argument('-s',
+                        '--speed',
+                        type=float,
+                        default=1.0,
+                        help='replay speed factor of the captured pace, 0 = max (default 1)')
+    parser.add_argument('-w',
+                        '--emit-batch-window',
+                        type=int,
+                        default=0,
+                        help='emit batch window in milliseconds, 0 = off (default 0)')
+    parser.add_argument('-b',
+                        '--emit-batch-size',
+                        type=int,
+                        default=100,
+                        help='max count of messages merged into one emit (default 100)')
+    parser.add_argument('--dedup-max-age',
+                        type=int,
+                        default=0,
+                        help='forward unchanged values at most once per N seconds, '
+                        '0 = off (default 0)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    try:
+        gateways = GatewaysConfig(args.config_file)
+        records = list(read_capture(args.capture_file))
+    except (OSError, ValueError) as exc:
+        logging.critical(exc)
+        sys.exit(1)
+
+    stub = StubLaporte()
+    sink = stub
+    if args.emit_batch_window > 0:
+        sink = EmitBatcher(stub, args.emit_batch_window / 1000, args.emit_batch_size)
+    dedup = ChangeFilter(args.dedup_max_age) if args.dedup_max_age > 0 else None
+    bridge = Mqqt(gateways, None, sink=sink, dedup=dedup, warmup_max=0)
+
+    start = perf_counter()
+    count = replay(bridge, records, args.speed)
+    elapsed = perf_counter() - start
+
+    # let throttle windows and the emit batch close
+    windows = [gateway.subscribe_throttle.window for gateway in gateways.get()
+               if gateway.subscribe_throttle is not None]
+    if windows:
+        sleep(max(windows))
+    if isinstance(sink, EmitBatcher):
+        sink.stop()
+
+    if records:
+        captured = records[-1][0] - records[0][0]
+        print(f"capture:    {len(records)} messages over {captured:.2f} s")
+    print(f"replayed:   {count} messages in {elapsed:.2f} s "
+          f"({count / max(elapsed, 1e-9):.0f} msgs/s, speed {args.speed or 'max'})")
+    print(f"emitted:    {stub.emits} emits, {stub.nodes} nodes, {stub.bytes / 2**20:.2f} MiB")
+    print(f"{'stage':<8} {'gateway':<16} {'count':>9} {'mean us':>9} {'p50 us':>9} "
+          f"{'p99 us':>9}")
+    for (stage, gateway), (total, mean, p50, p99) in sorted(
+            stage_stats().items(), key=lambda item: (STAGES.index(item[0][0]), item[0][1])):
+        print(f"{stage:<8} {gateway:<16} {total:>9.0f} {mean * 1e6:>9.1f} "
+              f"{p50 * 1e6:>9.1f} {p99 * 1e6:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
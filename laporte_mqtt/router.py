@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+'''
+Topic routing index built from the gateways config
+'''
+
+import re
+import logging
+from collections import namedtuple
+from functools import lru_cache
+from laporte_mqtt.nodes import intern
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+ROUTE_CACHE_SIZE_DEFAULT = 16384
+
+Route = namedtuple('Route', ['gateway', 'node_addr', 'key'])
+
+
+def filter_covers(outer: str, inner: str) -> bool:
+    '''check every topic matched by the inner topic filter is matched by the outer one'''
+
+    outer_levels = outer.split('/')
+    inner_levels = inner.split('/')
+
+    # wildcards at the first level do not match $SYS-like topics
+    if inner_levels[0].startswith('$') and outer_levels[0] in ('+', '#'):
+        return False
+
+    for depth, level in enumerate(outer_levels):
+        if level == '#':
+            return True
+        if depth == len(inner_levels):
+            return False
+        inner_level = inner_levels[depth]
+        if level == '+':
+            if inner_level == '#':
+                return False
+        elif level != inner_level:
+            return False
+
+    return len(outer_levels) == len(inner_levels)
+
+
+def covering_filters(filters: list) -> list:
+    '''
+    return a minimal list of topic filters (in the given order) matching
+    all topics of given filters, a filter covered by another one is left out
+    '''
+
+    ret = []
+    for index, topic_filter in enumerate(filters):
+        covered = False
+        for other_index, other in enumerate(filters):
+            if other_index == index or not filter_covers(other, topic_filter):
+                continue
+            # of equivalent filters keep the first one
+            if not filter_covers(topic_filter, other) or other_index < index:
+                covered = True
+                break
+        if not covered:
+            ret.append(topic_filter)
+    return ret
+
+
+class _TopicNode():
+    '''one level of the subscription trie'''
+
+    __slots__ = ('children', 'gateways')
+
+    def __init__(self):
+        self.children = {}
+        self.gateways = []
+
+
+class TopicRouter():
+    '''
+    MQTT wildcard trie keyed on topic levels with precompiled extractors,
+    one lookup returns routes (gateway, node address and key) of all
+    gateways matching a topic in order of precedence: a higher subscribe
+    priority first, then the config order; a gateway with the final flag
+    set stops the routing to gateways after it
+    '''
+    def __init__(self, gateways, cache_size=ROUTE_CACHE_SIZE_DEFAULT):
+        self.root = _TopicNode()
+        self.extractors = []
+
+        for gateway in gateways:
+            extractor = re.compile(gateway.subscribe_pattern.format("(.*)", "(.*)"))
+            # number of pattern groups expected by a subscribe schema
+            if extractor.groups != gateway.subscribe_codec.groups:
+                logging.error("gateway %s: pattern %s does not fit its schema",
+                              gateway.name, gateway.subscribe_pattern)
+                continue
+            self._insert(gateway.subscribe_topic, len(self.extractors))
+            self.extractors.append((gateway, extractor))
+
+        # sort key of gateway indexes: higher priority first, then config order
+        self.order = [(-gateway.subscribe_priority, index)
+                      for index, (gateway, _) in enumerate(self.extractors)]
+
+        self.match = lru_cache(maxsize=cache_size)(self._match)
+
+    def _insert(self, topic_filter, index):
+        '''add a subscribe topic filter of the gateway with given index'''
+
+        node = self.root
+        for level in topic_filter.split('/'):
+            node = node.children.setdefault(level, _TopicNode())
+        node.gateways.append(index)
+
+    def _lookup(self, node, levels, depth, found):
+        '''collect indexes of gateways whose topic filter matches levels'''
+
+        hashed = node.children.get('#')
+        if hashed is not None:
+            found.update(hashed.gateways)
+
+        if depth == len(levels):
+            found.update(node.gateways)
+            return
+
+        level = levels[depth]
+        child = node.children.get(level)
+        if child is not None:
+            self._lookup(child, levels, depth + 1, found)
+
+        child = node.children.get('+')
+        if child is not None:
+            self._lookup(child, levels, depth + 1, found)
+
+    def candidates(self, topic):
+        '''return gateways (in order of precedence) subscribed to a topic'''
+
+        found = set()
+        levels = topic.split('/')
+        if topic.startswith('$'):
+            # wildcards at the first level do not match $SYS-like topics
+            child = self.root.children.get(levels[0])
+            if child is not None:
+                self._lookup(child, levels, 1, found)
+        else:
+            self._lookup(self.root, levels, 0, found)
+
+        return [self.extractors[index] for index in sorted(found, key=self.order.__getitem__)]
+
+    def _match(self, topic):
+        '''return a tuple of Routes of a topic, empty if no gateway matches'''
+
+        ret = []
+        for gateway, extractor in self.candidates(topic):
+            match_obj = extractor.match(topic)
+            if not match_obj:
+                continue
+
+            # interned, so topics of a node share its address and keys
+            groups = match_obj.groups()
+            if not groups:
+                ret.append(Route(gateway, None, None))
+            elif len(groups) == 1:
+                ret.append(Route(gateway, intern(groups[0]), None))
+            else:
+                ret.append(Route(gateway, intern(groups[0]), intern(groups[1])))
+            if gateway.subscribe_final:
+                break
+
+        return tuple(ret)
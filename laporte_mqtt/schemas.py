@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+'''
+Codecs of node data in MQTT payloads (subscribe and publish schemas)
+'''
+
+# pylint: disable=import-outside-toplevel
+import json
+import logging
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+# groups: count of subscribe pattern groups (node address, key),
+# pattern: default subscribe pattern of a schema
+
+
+class JsonCodec():
+    '''a JSON document with keys of one node (node address in topic)'''
+
+    groups = 1
+    pattern = '.*/{}'
+
+    @staticmethod
+    def decode(payload, node_addr, key):
+        del key  # Ignored parameter
+        return {node_addr: json.loads(payload)}
+
+    @staticmethod
+    def encode(node_addr, keys):
+        '''return a list of (topic arguments, payload) to publish'''
+
+        return [((node_addr, ), json.dumps(keys))]
+
+
+class ValueCodec():
+    '''a single value (node address and key in topic)'''
+
+    groups = 2
+    pattern = '.*/{}/{}'
+
+    @staticmethod
+    def decode(payload, node_addr, key):
+        return {node_addr: {key: payload.decode('ascii')}}
+
+    @staticmethod
+    def encode(node_addr, keys):
+        return [((node_addr, key), value) for key, value in keys.items()]
+
+
+class MsgpackCodec():
+    '''a MessagePack map with keys of one node (node address in topic)'''
+
+    groups = 1
+    pattern = '.*/{}'
+
+    def __init__(self):
+        import msgpack
+        self.packb = msgpack.packb
+        self.unpackb = msgpack.unpackb
+        self.errors = (msgpack.UnpackException, ValueError, TypeError)
+
+    def decode(self, payload, node_addr, key):
+        del key  # Ignored parameter
+        try:
+            return {node_addr: self.unpackb(payload)}
+        except self.errors as exc:
+            raise ValueError(f"invalid MessagePack: {exc!r}") from exc
+
+    def encode(self, node_addr, keys):
+        return [((node_addr, ), self.packb(keys))]
+
+
+class CborCodec():
+    '''a CBOR map with keys of one node (node address in topic)'''
+
+    groups = 1
+    pattern = '.*/{}'
+
+    def __init__(self):
+        import cbor2
+        self.dumps = cbor2.dumps
+        self.loads = cbor2.loads
+        self.errors = (cbor2.CBORDecodeError, ValueError)
+
+    def decode(self, payload, node_addr, key):
+        del key  # Ignored parameter
+        try:
+            return {node_addr: self.loads(payload)}
+        except self.errors as exc:
+            raise ValueError(f"invalid CBOR: {exc!r}") from exc
+
+    def encode(self, node_addr, keys):
+        return [((node_addr, ), self.dumps(keys))]
+
+
+def split_unescaped(text, separator):
+    '''split text by a separator out of quotes and backslash escapes'''
+
+    ret = []
+    start = 0
+    quoted = False
+    escaped = False
+    for pos, char in enumerate(text):
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '"':
+            quoted = not quoted
+        elif char == separator and not quoted:
+            ret.append(text[start:pos])
+            start = pos + 1
+    ret.append(text[start:])
+    return ret
+
+
+def unescape(text):
+    return text.replace('\\ ', ' ').replace('\\,', ',').replace('\\=', '=')
+
+
+def parse_field_value(text):
+    '''return a python value of an influx line protocol field value'''
+
+    if text.startswith('"'):
+        if len(text) < 2 or not text.endswith('"'):
+            raise ValueError(f"unterminated string {text}")
+        return text[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    if text in ('t', 'T', 'true', 'True', 'TRUE'):
+        return True
+    if text in ('f', 'F', 'false', 'False', 'FALSE'):
+        return False
+    if text[-1:] in ('i', 'u'):
+        return int(text[:-1])
+    return float(text)
+
+
+def format_field_value(value):
+    '''return an influx line protocol field value of a python value'''
+
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return f'{value}i'
+    if isinstance(value, float):
+        return repr(value)
+    text = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{text}"'
+
+
+def escape(text, chars=' ,='):
+    for char in chars:
+        text = text.replace(char, '\\' + char)
+    return text
+
+
+class InfluxCodec():
+    '''
+    InfluxDB line protocol, one line per node: the measurement is a node
+    address (tags and timestamps are ignored), fields are keys of the node;
+    a payload may carry a batch of lines, the pattern has no node address
+    '''
+
+    groups = 0
+    pattern = '.*'
+
+    @staticmethod
+    def decode(payload, node_addr, key):
+        del node_addr, key  # Ignored parameters
+
+        ret = {}
+        for line in payload.decode('utf8').splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = [part for part in split_unescaped(line, ' ') if part]
+            if len(parts) < 2:
+                raise ValueError(f"no fields in line {line}")
+            node_addr = unescape(split_unescaped(parts[0], ',')[0])
+            keys = ret.setdefault(node_addr, {})
+            for field in split_unescaped(parts[1], ','):
+                name, sep, value = field.partition('=')
+                if not sep or not value:
+                    raise ValueError(f"invalid field {field}")
+                keys[unescape(name)] = parse_field_value(value)
+        return ret
+
+    @staticmethod
+    def encode(node_addr, keys):
+        fields = ','.join(f'{escape(str(key))}={format_field_value(value)}'
+                          for key, value in keys.items())
+        return [((node_addr, ), f'{escape(str(node_addr), " ,")} {fields}')]
+
+
+CODECS = {
+    'json': JsonCodec,
+    'value': ValueCodec,
+    'msgpack': MsgpackCodec,
+    'cbor': CborCodec,
+    'influx': InfluxCodec,
+}
+
+# packages of codecs with optional dependencies
+CODEC_PACKAGES = {'msgpack': 'msgpack', 'cbor': 'cbor2'}
+
+_codecs = {}
+
+
+def get_codec(name):
+    '''
+    return a shared codec instance of a schema name,
+    raise ImportError if its optional package is not installed
+    '''
+
+    codec = _codecs.get(name)
+    if codec is None:
+        try:
+            codec = CODECS[name]()
+        except ImportError as exc:
+            raise ImportError(f"schema {name} needs the {CODEC_PACKAGES.get(name)} "
+                              "package installed") from exc
+        _codecs[name] = codec
+    return codec
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+'''
+Disk-backed spool of sensor data while Laporte is unreachable
+'''
+
+import os
+import json
+import struct
+import logging
+import threading
+from time import monotonic, sleep
+from laporte_mqtt.batcher import merge_nodes
+from laporte_mqtt.metrics import (spool_size_bytes, spool_records_total,
+                                  spool_replayed_total, spool_dropped_total)
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+RECORD_HEADER = struct.Struct('<I')
+SEGMENT_PREFIX = 'spool-'
+SEGMENT_SUFFIX = '.dat'
+WRITE_BATCH = 100
+FLUSH_INTERVAL = 1.0
+COMPACT_CHUNK = 100
+
+
+class Spool():
+    '''
+    Emit stage capturing emits to an append-only segmented file while the
+    target (Laporte) is not connected. Records are written in batches, the
+    oldest segments are dropped above max_bytes. When the target is back,
+    spooled records are replayed in order with a rate limit (optionally
+    compacted to the latest value per node/key) and new emits keep going
+    to the spool until it is drained, so older values never overwrite
+    newer ones.
+    '''
+    def __init__(self,
+                 target,
+                 directory: str,
+                 max_bytes: int = 64 * 2**20,
+                 segment_bytes: int = 4 * 2**20,
+                 replay_rate: float = 100,
+                 compact: bool = False) -> None:
+        self.target = target
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.replay_rate = replay_rate
+        self.compact = compact
+        self.buffer = []
+        self.lock = threading.RLock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(
+            name for name in os.listdir(directory)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+        self.sizes = {
+            name: os.path.getsize(os.path.join(directory, name))
+            for name in self.segments
+        }
+        self.next_segment = 0
+        if self.segments:
+            self.next_segment = int(self.segments[-1][len(SEGMENT_PREFIX):-len(
+                SEGMENT_SUFFIX)]) + 1
+            logging.info("spool: %s segments of a previous run found", len(self.segments))
+        self.current = None
+        self.spooling = bool(self.segments)
+        self.size = 0
+        self.update_size()
+        spool_size_bytes.add(self.get_size)
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def update_size(self):
+        self.size = sum(self.sizes.values())
+
+    def get_size(self):
+        return self.size
+
+    def emit(self, response, message, stamps=None):
+        '''emit to the target or append to the spool'''
+
+        with self.lock:
+            if not self.spooling:
+                if self.target.is_connected():
+                    try:
+                        self.target.emit(response, message, stamps=stamps)
+                        return
+                    except Exception as exc:  # pylint: disable=broad-except
+                        logging.error("Laporte emit failed: %s", exc)
+                logging.warning("spool: Laporte unreachable, spooling sensor data")
+                self.spooling = True
+
+            # latencies of spooled messages are not observed (stamps are not replayed)
+            self.buffer.append(json.dumps([response, message]).encode())
+            spool_records_total.inc()
+            if len(self.buffer) >= WRITE_BATCH:
+                self.flush()
+
+    def open_segment(self):
+        '''start a new segment file (call with the lock held)'''
+
+        name = f'{SEGMENT_PREFIX}{self.next_segment:010d}{SEGMENT_SUFFIX}'
+        self.next_segment += 1
+        self.segments.append(name)
+        self.sizes[name] = 0
+        self.current = name
+
+    def flush(self):
+        '''append buffered records to the current segment (call with the lock held)'''
+
+        if not self.buffer:
+            return
+        if self.current is None or self.sizes[self.current] >= self.segment_bytes:
+            self.open_segment()
+
+        data = b''.join(RECORD_HEADER.pack(len(record)) + record for record in self.buffer)
+        self.buffer = []
+        with open(os.path.join(self.directory, self.current), 'ab') as stream:
+            stream.write(data)
+        self.sizes[self.current] += len(data)
+
+        while sum(self.sizes.values()) > self.max_bytes and len(self.segments) > 1:
+            name = self.segments.pop(0)
+            logging.error("spool: size limit reached, segment %s dropped", name)
+            spool_dropped_total.inc(self.sizes.pop(name))
+            os.remove(os.path.join(self.directory, name))
+        self.update_size()
+
+    def read_segment(self, name):
+        '''yield (response, message) records of a segment'''
+
+        with open(os.path.join(self.directory, name), 'rb') as stream:
+            data = stream.read()
+
+        pos = 0
+        while pos + RECORD_HEADER.size <= len(data):
+            (length, ) = RECORD_HEADER.unpack_from(data, pos)
+            pos += RECORD_HEADER.size
+            if pos + length > len(data):
+                logging.error("spool: truncated record in %s", name)
+                break
+            yield json.loads(data[pos:pos + length])
+            pos += length
+
+    def take_segments(self):
+        '''flush and detach all segments for replay'''
+
+        with self.lock:
+            self.flush()
+            self.current = None
+            return list(self.segments)
+
+    def remove_segment(self, name):
+        with self.lock:
+            self.segments.remove(name)
+            self.sizes.pop(name)
+            os.remove(os.path.join(self.directory, name))
+            self.update_size()
+
+    def replay_emit(self, response, message):
+        '''emit a replayed record with a rate limit'''
+
+        start = monotonic()
+        self.target.emit(response, message)
+        spool_replayed_total.inc()
+        if self.replay_rate > 0:
+            delay = 1 / self.replay_rate - (monotonic() - start)
+            if delay > 0:
+                sleep(delay)
+
+    def replay(self):
+        '''replay spooled segments while the target is connected'''
+
+        while not self.stopped.is_set():
+            segments = self.take_segments()
+            if not segments:
+                with self.lock:
+                    if not self.buffer and not self.segments:
+                        self.spooling = False
+                        logging.info("spool: replay finished")
+                        return
+                continue
+
+            if self.compact:
+                batches = {}
+                for name in segments:
+                    for response, message in self.read_segment(name):
+                        merge_nodes(batches.setdefault(response, {}), message)
+                for response, nodes in batches.items():
+                    items = list(nodes.items())
+                    for i in range(0, len(items), COMPACT_CHUNK):
+                        self.replay_emit(response, dict(items[i:i + COMPACT_CHUNK]))
+                for name in segments:
+                    self.remove_segment(name)
+            else:
+                for name in segments:
+                    # segments left by stop() are replayed by a next run
+                    if self.stopped.is_set():
+                        return
+                    for response, message in self.read_segment(name):
+                        self.replay_emit(response, message)
+                    self.remove_segment(name)
+
+    def stop(self):
+        '''finish the loop (and a replay) and write buffered records'''
+
+        self.stopped.set()
+        self.thread.join()
+        with self.lock:
+            self.flush()
+        spool_size_bytes.remove(self.get_size)
+
+    def loop(self):
+        '''flush buffered records and replay them when the target is back until stop()'''
+
+        while not self.stopped.wait(FLUSH_INTERVAL):
+            with self.lock:
+                self.flush()
+                spooling = self.spooling
+            if spooling and self.target.is_connected():
+                logging.info("spool: Laporte reachable, replaying sensor data")
+                try:
+                    self.replay()
+                except Exception as exc:  # pylint: disable=broad-except
+                    logging.error("spool: replay interrupted: %s", exc)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+'''
+Per-node throttling with windowed aggregation of sensor values
+'''
+
+import heapq
+import logging
+import threading
+from time import monotonic
+from laporte_mqtt.metrics import throttle_nodes, throttle_aggregated_total
+from laporte_mqtt.nodes import node_registry, intern
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+REDUCE_LAST = 'last'
+REDUCE_MIN = 'min'
+REDUCE_MAX = 'max'
+REDUCE_AVG = 'avg'
+REDUCERS = [REDUCE_LAST, REDUCE_MIN, REDUCE_MAX, REDUCE_AVG]
+
+
+class ThrottleConfig():
+    '''throttle setup of one gateway'''
+
+    __slots__ = ('window', 'reduce', 'default')
+
+    def __init__(self, window=1.0, reduce=None):
+        self.window = float(window)
+        self.reduce = {}
+        self.default = REDUCE_LAST
+        for key, reducer in (reduce or {}).items():
+            if reducer not in REDUCERS:
+                logging.error("unknown throttle reducer %s (choose from %s)", reducer,
+                              REDUCERS)
+                reducer = REDUCE_LAST
+            if key == 'default':
+                self.default = reducer
+            else:
+                self.reduce[key] = reducer
+
+    def get_reducer(self, key):
+        return self.reduce.get(key, self.default)
+
+
+class _KeyState():
+    '''reduced samples of one key within a window'''
+
+    __slots__ = ('reducer', 'value', 'number', 'count')
+
+    def __init__(self, reducer, value):
+        self.reducer = reducer
+        self.value = value
+        self.number = None
+        self.count = 0
+        self.add(value)
+
+    def add(self, value):
+        if self.reducer == REDUCE_LAST:
+            self.value = value
+            return
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            # not a number, keep the last value
+            self.value = value
+            self.number = None
+            self.count = 0
+            return
+
+        self.count += 1
+        if self.number is None:
+            self.value = value
+            self.number = number
+        elif self.reducer == REDUCE_AVG:
+            self.number += number
+        elif (self.reducer == REDUCE_MIN and number < self.number) or \
+                (self.reducer == REDUCE_MAX and number > self.number):
+            self.value = value
+            self.number = number
+
+    def result(self):
+        if self.reducer == REDUCE_AVG and self.count:
+            return self.number / self.count
+        return self.value
+
+
+class _NodeWindow():
+    '''window state of one node'''
+
+    __slots__ = ('config', 'keys', 'scalar', 'stamps')
+
+    def __init__(self, config):
+        self.config = config
+        self.keys = {}
+        self.scalar = None
+        self.stamps = []
+
+
+class Throttle():
+    '''
+    Forward the first sample of a node at once and open a fixed window,
+    samples inside the window are reduced per key (last/min/max/avg)
+    and forwarded once when the window closes. A node without samples
+    in its window is evicted.
+    '''
+    def __init__(self, forward) -> None:
+        self.forward = forward
+        self.nodes = {}
+        self.deadlines = []
+        self.running = True
+        self.cond = threading.Condition()
+        self.thread = None
+        throttle_nodes.add(self.__len__)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add(self, gateway, message, stamps=None) -> None:
+        '''
+        add a {node: {key: value}} message of a gateway with throttle config,
+        its stamps are forwarded with the last of its values
+        '''
+
+        config = gateway.subscribe_throttle
+        forward = {}
+        aggregated = None
+
+        with self.cond:
+            for node_addr, value in message.items():
+                item = node_registry.node(gateway.name, node_addr)
+                window = self.nodes.get(item)
+                if window is None:
+                    # idle node: forward at once and open a window
+                    self.nodes[item] = _NodeWindow(config)
+                    heapq.heappush(self.deadlines, (monotonic() + config.window, item))
+                    forward[node_addr] = value
+                    continue
+
+                throttle_aggregated_total.inc()
+                aggregated = window
+                if not isinstance(value, dict):
+                    window.scalar = value
+                    continue
+                for key, key_value in value.items():
+                    state = window.keys.get(key)
+                    if state is None:
+                        window.keys[intern(key)] = _KeyState(config.get_reducer(key),
+                                                             key_value)
+                    else:
+                        state.add(key_value)
+
+            if aggregated is not None and stamps:
+                aggregated.stamps.extend(stamps)
+                stamps = None
+
+            if self.thread is None and self.running:
+                self.thread = threading.Thread(target=self.loop, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+        if forward:
+            self.forward(gateway.name, forward, stamps)
+
+    def close_windows(self, now):
+        '''close due windows, return {gateway: ({node: values}, stamps)} to forward'''
+
+        ret = {}
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, item = heapq.heappop(self.deadlines)
+            window = self.nodes[item]
+            if not window.keys and window.scalar is None:
+                del self.nodes[item]
+                continue
+
+            gateway_name, node_addr = item
+            if window.keys:
+                value = {key: state.result() for key, state in window.keys.items()}
+            else:
+                value = window.scalar
+            message, stamps = ret.setdefault(gateway_name, ({}, []))
+            message[node_addr] = value
+            stamps.extend(window.stamps)
+
+            # keep the rate: open a next window
+            self.nodes[item] = _NodeWindow(window.config)
+            heapq.heappush(self.deadlines, (now + window.config.window, item))
+        return ret
+
+    def stop(self):
+        '''finish the loop, open windows are not forwarded'''
+
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+
+    def loop(self):
+        '''forward reduced samples when their windows close until stop()'''
+
+        while True:
+            with self.cond:
+                while not self.deadlines and self.running:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                timeout = self.deadlines[0][0] - monotonic()
+                if timeout > 0:
+                    self.cond.wait(timeout)
+                    continue
+                messages = self.close_windows(monotonic())
+
+            for gateway_name, (message, stamps) in messages.items():
+                try:
+                    self.forward(gateway_name, message, stamps)
+                except Exception as exc:  # pylint: disable=broad-except
+                    logging.error("throttled emit failed: %s", exc)
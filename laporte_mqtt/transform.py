@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+'''
+Per-gateway transformation of decoded payload fields
+'''
+
+import logging
+from laporte_mqtt.msglog import message_log
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+BOOL_TRUE = {'1', 'on', 'true', 'yes'}
+BOOL_FALSE = {'0', 'off', 'false', 'no'}
+
+
+def to_bool(value):
+    '''cast a payload value to bool ('ON'/'off', 'true', 1, ...)'''
+
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in BOOL_TRUE:
+        return True
+    if text in BOOL_FALSE:
+        return False
+    raise ValueError(f"not a bool value: {value!r}")
+
+
+def to_int(value):
+    '''cast a payload value to int (also '21.0')'''
+
+    if isinstance(value, str):
+        return int(round(float(value)))
+    return int(value)
+
+
+CASTS = {'int': to_int, 'float': float, 'bool': to_bool, 'str': str}
+
+
+def scaled(cast, scale):
+    '''return a converter multiplying a number by scale before the cast'''
+
+    if cast is None:
+        cast = float
+    if cast is to_int:
+        return lambda value: int(round(float(value) * scale))
+    return lambda value: cast(float(value) * scale)
+
+
+class TransformPlan():
+    '''
+    Transformation of {key: value} node data compiled once from a gateway
+    config: a whitelist of keys, renames, numeric casting and scaling.
+    Keys out of the whitelist are dropped, keys without a rule pass through.
+    '''
+
+    __slots__ = ('gateway_name', 'rules', 'whitelist')
+
+    def __init__(self, gateway_name, keys=None, transform=None):
+        self.gateway_name = gateway_name
+        self.whitelist = keys is not None
+        self.rules = {}
+
+        transform = transform or {}
+        for key in (keys if keys is not None else transform):
+            rule = transform.get(key) or {}
+            name = rule.get('rename', key)
+            cast = None
+            if 'type' in rule:
+                cast = CASTS.get(rule['type'])
+                if cast is None:
+                    logging.error("unknown transform type %s (choose from %s)",
+                                  rule['type'], list(CASTS))
+            if 'scale' in rule:
+                if cast in (str, to_bool):
+                    logging.error("transform of %s: scale needs a numeric type", key)
+                else:
+                    cast = scaled(cast, float(rule['scale']))
+            self.rules[key] = (name, cast)
+
+    def accepts(self, key) -> bool:
+        '''check if a key passes the whitelist'''
+
+        return not self.whitelist or key in self.rules
+
+    def convert(self, key, cast, value):
+        '''return a converted value, None if the cast failed'''
+
+        try:
+            return cast(value)
+        except (TypeError, ValueError) as exc:
+            message_log.warning(f'{self.gateway_name}/{key}',
+                                "transform of %s %s failed: %s", self.gateway_name, key, exc)
+            return None
+
+    def apply(self, values: dict) -> dict:
+        '''return transformed node data'''
+
+        ret = {}
+        if self.whitelist:
+            for key, (name, cast) in self.rules.items():
+                if key in values:
+                    value = values[key]
+                    if cast is not None:
+                        value = self.convert(key, cast, value)
+                        if value is None:
+                            continue
+                    ret[name] = value
+            return ret
+
+        for key, value in values.items():
+            rule = self.rules.get(key)
+            if rule is None:
+                ret[key] = value
+                continue
+            name, cast = rule
+            if cast is not None:
+                value = self.convert(key, cast, value)
+                if value is None:
+                    continue
+            ret[name] = value
+        return ret
@@ -5,7 +5,6 @@ app version and resources info
 
 import time
 from platform import python_version
-import pkg_resources
 
 __version__ = '0.3.0'
 app_name = 'laporte-mqtt'
@@ -27,6 +26,10 @@ def get_version_info():
 def get_runtime_info():
     '''get app and resources runtime info'''
 
+    # pylint: disable=import-outside-toplevel
+    # slow to import, needed by --version only
+    import pkg_resources
+
     modules = {
         'paho-mqtt': pkg_resources.get_distribution("paho-mqtt").version,
         'python-socketio': pkg_resources.get_distribution("python-socketio").version,
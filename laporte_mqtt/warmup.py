@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+'''
+Bulk ingest of retained messages replayed by the broker after a subscribe
+'''
+
+import logging
+import threading
+from time import monotonic
+from laporte_mqtt.batcher import merge_nodes
+from laporte_mqtt.metrics import warmup_duration, warmup_retained_total
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+SNAPSHOT_CHUNK = 1000
+
+
+class Warmup():
+    '''
+    Collect retained messages delivered after a subscribe into a snapshot
+    per gateway, forwarded in bulk emits (up to SNAPSHOT_CHUNK nodes each)
+    when they stop coming for the quiet period after the subscribe was
+    acknowledged, or after max_duration. A live message during the warmup
+    supersedes snapshot values of the same keys.
+    '''
+    def __init__(self, forward, quiet: float = 0.2, max_duration: float = 10) -> None:
+        self.forward = forward
+        self.quiet = quiet
+        self.max_duration = max_duration
+        self.active = False
+        self.pending = 0
+        self.started = 0
+        self.last = 0
+        self.snapshot = {}
+        self.stamps = {}
+        self.running = True
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def connected(self) -> None:
+        '''forget subscribes of a lost connection, they are never acknowledged'''
+
+        with self.cond:
+            self.pending = 0
+            self.cond.notify()
+
+    def start(self) -> None:
+        '''begin (or extend) a warmup before a subscribe is sent'''
+
+        with self.cond:
+            if not self.active:
+                self.active = True
+                self.started = monotonic()
+                self.last = self.started
+                logging.info("MQTT warmup started")
+            self.pending += 1
+
+            if self.thread is None and self.running:
+                self.thread = threading.Thread(target=self.loop, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def acked(self) -> None:
+        '''a subscribe was acknowledged, retained messages follow'''
+
+        with self.cond:
+            self.pending = max(self.pending - 1, 0)
+            self.last = monotonic()
+            self.cond.notify()
+
+    def add(self, gateway_name, message, stamps=None) -> bool:
+        '''collect a retained message (and its stamps), return False if the warmup is over'''
+
+        with self.cond:
+            if not self.active:
+                return False
+            merge_nodes(self.snapshot.setdefault(gateway_name, {}), message)
+            if stamps:
+                self.stamps.setdefault(gateway_name, []).extend(stamps)
+            self.last = monotonic()
+        warmup_retained_total.inc()
+        return True
+
+    def discard(self, gateway_name, message) -> None:
+        '''drop snapshot values superseded by a live message'''
+
+        if not self.snapshot:
+            return
+        with self.cond:
+            nodes = self.snapshot.get(gateway_name)
+            if not nodes:
+                return
+            for node_addr, value in message.items():
+                current = nodes.get(node_addr)
+                if isinstance(current, dict) and isinstance(value, dict):
+                    for key in value:
+                        current.pop(key, None)
+                    if current:
+                        continue
+                nodes.pop(node_addr, None)
+
+    def deadline(self) -> float:
+        '''time the warmup ends if no retained message comes (call with the lock held)'''
+
+        ret = self.started + self.max_duration
+        if self.pending == 0:
+            ret = min(ret, self.last + self.quiet)
+        return ret
+
+    def finish(self) -> None:
+        '''end the warmup and forward the snapshot in bulk'''
+
+        with self.cond:
+            snapshot = self.snapshot
+            stamps = self.stamps
+            self.snapshot = {}
+            self.stamps = {}
+            self.active = False
+            duration = monotonic() - self.started
+
+        warmup_duration.set(duration)
+        count = 0
+        for gateway_name, nodes in snapshot.items():
+            items = list(nodes.items())
+            for i in range(0, len(items), SNAPSHOT_CHUNK):
+                # stamps of retained messages go with the last chunk
+                chunk_stamps = None
+                if i + SNAPSHOT_CHUNK >= len(items):
+                    chunk_stamps = stamps.get(gateway_name)
+                try:
+                    self.forward(gateway_name, dict(items[i:i + SNAPSHOT_CHUNK]), chunk_stamps)
+                except Exception as exc:  # pylint: disable=broad-except
+                    logging.error("MQTT warmup snapshot emit failed: %s", exc)
+            count += len(items)
+        logging.info("MQTT warmup complete in %.3f s, snapshot of %s nodes", duration, count)
+
+    def stop(self) -> None:
+        '''finish the loop, a snapshot being collected is not forwarded'''
+
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+
+    def loop(self):
+        '''finish warmups when their deadline passes until stop()'''
+
+        while True:
+            with self.cond:
+                while not self.active and self.running:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                timeout = self.deadline() - monotonic()
+                if timeout > 0:
+                    self.cond.wait(timeout)
+                    continue
+            self.finish()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+'''
+Multi-process scale-out: supervise worker processes sharing MQTT subscriptions
+'''
+
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from prometheus_client import CollectorRegistry, start_http_server
+from prometheus_client import multiprocess
+
+# create logger
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+RESTART_DELAY = 5
+
+
+class Supervisor():
+    '''
+    Start worker processes (each one is a bridge subscribed through
+    $share/<group>/<topic>), restart them when they exit and expose
+    their aggregated prometheus metrics.
+    '''
+    def __init__(self, count: int, argv: list = None) -> None:
+        self.count = count
+        self.argv = sys.argv[1:] if argv is None else argv
+        self.procs = {}
+        self.running = True
+        self.metrics_dir = tempfile.mkdtemp(prefix='laporte-mqtt-metrics-')
+        self.env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=self.metrics_dir)
+
+    def start_worker(self, worker_id: int) -> None:
+        '''spawn a worker process'''
+
+        cmd = [
+            sys.executable, '-m', 'laporte_mqtt', *self.argv, '--workers', '0',
+            '--worker-id',
+            str(worker_id)
+        ]
+        proc = subprocess.Popen(cmd, env=self.env)  # pylint: disable=consider-using-with
+        logging.info("worker %s started (pid=%s)", worker_id, proc.pid)
+        self.procs[worker_id] = proc
+
+    def stop(self, *_) -> None:
+        '''terminate all workers'''
+
+        self.running = False
+        for proc in self.procs.values():
+            if proc.poll() is None:
+                proc.terminate()
+
+    def reload(self, *_) -> None:
+        '''forward a config reload request to all workers'''
+
+        for proc in self.procs.values():
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGHUP)
+
+    def run(self, listen_addr: str, listen_port: int) -> None:
+        '''start workers and supervise them until a termination signal'''
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, path=self.metrics_dir)
+        start_http_server(listen_port, addr=listen_addr, registry=registry)
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self.reload)
+
+        for worker_id in range(self.count):
+            self.start_worker(worker_id)
+
+        restarts = {}
+        while self.running:
+            time.sleep(1)
+            for worker_id, proc in list(self.procs.items()):
+                ret = proc.poll()
+                if ret is None or not self.running:
+                    continue
+                if worker_id not in restarts:
+                    logging.error("worker %s exited (ret=%s)", worker_id, ret)
+                    multiprocess.mark_process_dead(proc.pid, path=self.metrics_dir)
+                    restarts[worker_id] = time.monotonic() + RESTART_DELAY
+                elif time.monotonic() >= restarts[worker_id]:
+                    del restarts[worker_id]
+                    self.start_worker(worker_id)
+
+        for proc in self.procs.values():
+            proc.wait()
+        shutil.rmtree(self.metrics_dir, ignore_errors=True)
@@ -31,11 +31,19 @@ setuptools.setup(name="laporte-mqtt",
                  zip_safe=False,
                  packages=setuptools.find_packages(),
                  install_requires=required,
+                 extras_require={
+                     'asyncio': ['aiohttp'],
+                     'msgpack': ['msgpack'],
+                     'cbor': ['cbor2'],
+                 },
                  classifiers=[
                      "Programming Language :: Python :: 3",
                      "License :: OSI Approved :: MIT License",
                      "Operating System :: OS Independent",
                  ],
                  entry_points={
-                     'console_scripts': ['laporte-mqtt=laporte_mqtt.main:main'],
+                     'console_scripts': [
+                         'laporte-mqtt=laporte_mqtt.main:main',
+                         'laporte-mqtt-replay=laporte_mqtt.replay:main',
+                     ],
                  })